@@ -1,27 +1,36 @@
 class MongoAggregate(object):
+    """
+    An aggregate computed by a ``$group`` stage of an aggregation
+    pipeline.
+
+    :param alias: the name of the aggregate in the results
+    :param lookup: the document key to aggregate (``None`` for ``*``)
+    :param source: the aggregated field
+    :param distinct: whether to only aggregate distinct values
+    """
     is_ordinal = False
     is_computed = False
-    reduce_template = NotImplemented
-    finalize_template = ''
+    group_operator = NotImplemented
 
-    def __init__(self, alias, lookup, source):
+    def __init__(self, alias, lookup, source, distinct=False):
         self.alias = alias
         self.lookup = lookup
         self.field = self.source = source
-
-    def format(self, template):
-        alias = 'out.%s' % self.alias
-        lookup = 'doc.%s' % self.lookup
-        return template.format(alias=alias, lookup=lookup)
-
-    def initial(self):
-        return {self.alias: self.initial_value}
-
-    def reduce(self):
-        return self.format(self.reduce_template)
-
-    def finalize(self):
-        return self.format(self.finalize_template)
+        self.distinct = distinct
+
+    def group(self):
+        """
+        Returns the accumulator expression for the ``$group`` stage.
+        """
+        return {self.group_operator: '$' + self.lookup}
+
+    def project(self):
+        """
+        Returns the expression that computes the final value from the
+        ``$group`` output in a ``$project`` stage, or ``None`` if the
+        ``$group`` output already is the final value.
+        """
+        return None
 
     def as_sql(self):
         raise NotImplementedError
@@ -29,35 +38,37 @@ class MongoAggregate(object):
 
 class Count(MongoAggregate):
     is_ordinal = True
-    initial_value = 0
-    reduce_template = '{alias}++'
+
+    def group(self):
+        if self.distinct:
+            return {'$addToSet': '$' + self.lookup}
+        if self.lookup in (None, '_id'):
+            return {'$sum': 1}
+        # Like COUNT(field), don't count null values.
+        is_set = {'$gt': ['$' + self.lookup, None]}
+        return {'$sum': {'$cond': [is_set, 1, 0]}}
+
+    def project(self):
+        if self.distinct:
+            return {'$size': {'$setDifference': ['$' + self.alias, [None]]}}
 
 
 class Min(MongoAggregate):
-    initial_value = float('inf')
-    reduce_template = '{alias} = ({lookup} < {alias}) ? {lookup}: {alias}'
+    group_operator = '$min'
 
 
 class Max(MongoAggregate):
-    initial_value = float('-inf')
-    reduce_template = '{alias} = ({lookup} > {alias}) ? {lookup}: {alias}'
+    group_operator = '$max'
 
 
 class Avg(MongoAggregate):
     is_computed = True
-
-    def initial(self):
-        return {'%s__count' % self.alias: 0, '%s__total' % self.alias: 0}
-
-    reduce_template = '{alias}__count++; {alias}__total += {lookup}'
-    finalize_template = '{alias} = {alias}__total / {alias}__count'
+    group_operator = '$avg'
 
 
 class Sum(MongoAggregate):
     is_computed = True
-    initial_value = 0
-
-    reduce_template = '{alias} += {lookup}'
+    group_operator = '$sum'
 
 
 _AGGREGATION_CLASSES = dict((cls.__name__, cls)
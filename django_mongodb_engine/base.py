@@ -1,12 +1,15 @@
+from contextlib import contextmanager
 import copy
 import datetime
 import decimal
+import os
 import sys
 import warnings
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.db.backends.signals import connection_created
+from django.db.models.sql.expressions import SQLEvaluator
 from django.db.utils import DatabaseError
 from pymongo import ReadPreference
 
@@ -31,13 +34,16 @@ from djangotoolbox.db.base import (
 )
 from djangotoolbox.db.utils import decimal_to_string
 
+from . import pool
 from .creation import DatabaseCreation
-from .utils import CollectionDebugWrapper
+from .query import ArrayUpdate, UpdateOperator
+from .utils import DATE_PARTS, CollectionDebugWrapper, make_read_preference
 
 
 class DatabaseFeatures(NonrelDatabaseFeatures):
     supports_microsecond_precision = False
     supports_long_model_names = False
+    has_bulk_insert = True
 
     can_rollback_ddl = True
 
@@ -56,6 +62,13 @@ class DatabaseOperations(NonrelDatabaseOperations):
             raise NotImplementedError("django-mongodb-engine doesn't support "
                                       "%r aggregates." % type(aggregate))
 
+    def bulk_batch_size(self, fields, objs):
+        """
+        Limits the number of documents Django passes to a single
+        insert to the server's maxWriteBatchSize.
+        """
+        return self.connection.connection.max_write_batch_size
+
     def sql_flush(self, style, tables, sequence_list, allow_cascade=False):
         """
         Returns a list of SQL statements that have to be executed to
@@ -86,6 +99,23 @@ class DatabaseOperations(NonrelDatabaseOperations):
             return None
         return unicode(value)
 
+    def value_for_db(self, value, field, lookup=None):
+        # F() expressions in filters are translated by the compiler.
+        if isinstance(value, SQLEvaluator):
+            return value
+        return super(DatabaseOperations, self).value_for_db(
+            value, field, lookup)
+
+    def _convert_as(self, field, lookup=None):
+        field, field_kind, db_type = super(DatabaseOperations, self) \
+            ._convert_as(field, lookup)
+        # Values of all date part lookups (not only month / day
+        # ones) are integers.
+        if (field_kind in ('DateField', 'DateTimeField') and
+                lookup in DATE_PARTS):
+            db_type = 'integer'
+        return field, field_kind, db_type
+
     def _value_for_db(self, value, field, field_kind, db_type, lookup):
         """
         Allows parent to handle nonrel fields, convert AutoField
@@ -98,6 +128,20 @@ class DatabaseOperations(NonrelDatabaseOperations):
         if value is None:
             return None
 
+        # Convert the values of Push(...) etc. like the field's items.
+        if isinstance(value, ArrayUpdate):
+            if field_kind not in ('ListField', 'SetField'):
+                raise DatabaseError("%s() can only update ListFields and "
+                                    "SetFields." % value.__class__.__name__)
+            return value.convert(lambda items: self._value_for_db(
+                field.get_db_prep_save(items, connection=self.connection),
+                field, field_kind, db_type, lookup))
+        # ... and those of MaxUpdate(...) etc. like the field's values.
+        if isinstance(value, UpdateOperator):
+            return value.convert(lambda value: self._value_for_db(
+                field.get_db_prep_save(value, connection=self.connection),
+                field, field_kind, db_type, lookup))
+
         # Parent can handle iterable fields and Django wrappers.
         value = super(DatabaseOperations, self)._value_for_db(
             value, field, field_kind, db_type, lookup)
@@ -176,7 +220,9 @@ class DatabaseValidation(NonrelDatabaseValidation):
 class DatabaseIntrospection(NonrelDatabaseIntrospection):
 
     def table_names(self, cursor=None):
-        return self.connection.database.collection_names()
+        names = self.connection.database.collection_names()
+        self.connection._collection_names = set(names)
+        return names
 
     def sequence_list(self):
         # Only required for backends that use integer primary keys.
@@ -185,7 +231,8 @@ class DatabaseIntrospection(NonrelDatabaseIntrospection):
 
 class DatabaseWrapper(NonrelDatabaseWrapper):
     """
-    Public API: connection, database, get_collection.
+    Public API: connection, database, get_collection, get_pool_stats,
+    get_write_options, invalidate_collection_names, write_concern.
     """
 
     def __init__(self, *args, **kwargs):
@@ -199,18 +246,102 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
         self.validation = DatabaseValidation(self)
         self.connected = False
         del self.connection
+        self._collections = {}
+        self._collection_names = None
+        self._write_concerns = []
 
     def get_collection(self, name, **kwargs):
+        """
+        Returns the collection `name`.
+
+        Collection objects are cached per wrapper. If `existing` is
+        ``True``, returns ``None`` if the collection doesn't exist. The
+        list of collection names is cached as well, but it is fetched
+        again if `name` isn't in it, since collections are also created
+        implicitly by writes.
+
+        If `read_preference` is given, reads through the returned
+        collection object are routed accordingly (see
+        :func:`~django_mongodb_engine.utils.make_read_preference`), still
+        using this wrapper's client. Any other keyword arguments are
+        passed to the collection class, which makes PyMongo create the
+        collection with these options.
+        """
+        if self.connected and self._connected_pid != os.getpid():
+            # Don't use a client inherited from the parent process.
+            self._reconnect()
         if (kwargs.pop('existing', False) and
-                name not in self.database.collection_names()):
-            return None
+                name not in self._get_collection_names()):
+            self.invalidate_collection_names()
+            if name not in self._get_collection_names():
+                return None
+
+        read_preference = kwargs.pop('read_preference', None)
+        if read_preference is not None:
+            read_preference = make_read_preference(read_preference)
+        # PyMongo 3 read preferences aren't hashable by value.
+        key = name, settings.DEBUG, repr(read_preference)
+        if not kwargs and key in self._collections:
+            return self._collections[key]
+
         collection = self.collection_class(self.database, name, **kwargs)
+        if read_preference is not None:
+            if hasattr(collection, 'with_options'):
+                collection = collection.with_options(
+                    read_preference=read_preference)
+            else:
+                collection.read_preference = read_preference
         if settings.DEBUG:
             collection = CollectionDebugWrapper(collection, self.alias)
+        if kwargs and self._collection_names is not None:
+            self._collection_names.add(name)
+        self._collections[key] = collection
         return collection
 
+    @contextmanager
+    def write_concern(self, **flags):
+        """
+        Makes all writes through this wrapper inside the ``with`` block
+        use the write concern `flags` (e.g. ``w=0``), overriding the
+        ``OPERATIONS`` flags and the models' ``write_concern``.
+        """
+        self._write_concerns.append(flags)
+        try:
+            yield
+        finally:
+            self._write_concerns.pop()
+
+    def get_write_options(self, operation, model, write_concern=None):
+        """
+        Returns the keyword arguments for the PyMongo call that does the
+        Django `operation` (``'save'``, ``'update'``, ``'delete'`` or
+        ``'bulk_create'``) on `model`: The ``OPERATIONS`` flags,
+        overridden by the model's ``write_concern``, the innermost
+        :meth:`write_concern` block and `write_concern`, in that order.
+        """
+        options = dict(self.operation_flags.get(operation, {}))
+        options.update(getattr(model._meta, 'write_concern', None) or {})
+        if self._write_concerns:
+            options.update(self._write_concerns[-1])
+        options.update(write_concern or {})
+        return options
+
+    def invalidate_collection_names(self):
+        """
+        Forgets the cached list of collection names. Must be called
+        after dropping or renaming collections without using the
+        engine.
+        """
+        self._collection_names = None
+
+    def _get_collection_names(self):
+        if self._collection_names is None:
+            self._collection_names = set(self.database.collection_names())
+        return self._collection_names
+
     def __getattr__(self, attr):
-        if attr in ['connection', 'database']:
+        if attr in ['connection', 'database', 'operation_flags',
+                    'query_plan_checks', 'max_time_ms']:
             assert not self.connected
             self._connect()
             return getattr(self, attr)
@@ -230,12 +361,21 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
         options = pop('OPTIONS', {})
 
         self.operation_flags = options.pop('OPERATIONS', {})
-        if not any(k in ['save', 'delete', 'update']
+        share_client = options.pop('SHARE_CLIENT', True)
+        self.query_plan_checks = options.pop('CHECK_QUERY_PLANS', None)
+        self.max_time_ms = options.pop('MAX_TIME_MS', None)
+        if self.query_plan_checks is True:
+            self.query_plan_checks = {}
+        if not any(k in ['save', 'delete', 'update', 'bulk_create']
                    for k in self.operation_flags):
             # Flags apply to all operations.
             flags = self.operation_flags
             self.operation_flags = {'save': flags, 'delete': flags,
-                                    'update': flags}
+                                    'update': flags, 'bulk_create': flags}
+        else:
+            # bulk_create uses the save flags unless told otherwise.
+            self.operation_flags.setdefault(
+                'bulk_create', self.operation_flags.get('save', {}))
 
         # Lower-case all OPTIONS keys.
         for key in options.iterkeys():
@@ -265,7 +405,12 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
             connection_class = MongoClient
 
         try:
-            self.connection = connection_class(**conn_options)
+            if share_client:
+                self.connection, self._pool_stats = pool.get_client(
+                    connection_class, conn_options, (user, password))
+            else:
+                self.connection = connection_class(**conn_options)
+                self._pool_stats = None
             self.database = self.connection[db_name]
         except TypeError:
             exc_info = sys.exc_info()
@@ -275,14 +420,29 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
             if not self.database.authenticate(user, password):
                 raise ImproperlyConfigured("Invalid username or password.")
 
+        self._connected_pid = os.getpid()
         self.connected = True
         connection_created.send(sender=self.__class__, connection=self)
 
+    def get_pool_stats(self):
+        """
+        Returns usage statistics of the client shared by all wrappers
+        with this wrapper's connection settings (see
+        :class:`~django_mongodb_engine.pool.PoolStats`), or ``None`` if
+        client sharing is disabled.
+        """
+        if not self.connected:
+            self._connect()
+        if self._pool_stats is not None:
+            return self._pool_stats.as_dict()
+
     def _reconnect(self):
         if self.connected:
             del self.connection
             del self.database
             self.connected = False
+        self._collections.clear()
+        self.invalidate_collection_names()
         self._connect()
 
     def _commit(self):
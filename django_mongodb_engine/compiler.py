@@ -1,18 +1,26 @@
+import datetime
+from decimal import Decimal
 from functools import wraps
 import re
 import sys
 
-import django
+from django.conf import settings
 from django.db.models import F, NOT_PROVIDED
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.expressions import ExpressionNode
 from django.db.models.sql import aggregates as sqlaggregates
 from django.db.models.sql.constants import MULTI
+from django.db.models.sql.expressions import SQLEvaluator
 from django.db.models.sql.where import OR
 from django.db.utils import DatabaseError, IntegrityError
+from django.utils import timezone
 from django.utils.encoding import smart_str
 from django.utils.tree import Node
 
+from bson.son import SON
+import pymongo
 from pymongo import ASCENDING, DESCENDING
-from pymongo.errors import PyMongoError, DuplicateKeyError
+from pymongo.errors import PyMongoError, DuplicateKeyError, ExecutionTimeout
 
 from djangotoolbox.db.basecompiler import (
     NonrelQuery,
@@ -21,24 +29,22 @@ from djangotoolbox.db.basecompiler import (
     NonrelUpdateCompiler,
     NonrelDeleteCompiler,
     EmptyResultSet)
+from djangotoolbox.fields import AbstractIterableField
 
 from .aggregations import get_aggregation_class_by_name
-from .query import A
-from .utils import safe_regex
-
-
-if django.VERSION >= (1, 6):
-    def get_selected_fields(query):
-        fields = None
-        if query.select and not query.aggregates:
-            fields = [info.field.column for info in query.select]
-        return fields
-else:
-    def get_selected_fields(query):
-        fields = None
-        if query.select_fields and not query.aggregates:
-            fields = [field.column for field in query.select_fields]
-        return fields
+from .models import take_snapshot
+from .query import A, UpdateOperator
+from .utils import (
+    LRUCache,
+    MaxTimeExceeded,
+    QueryPlan,
+    QueryPlanError,
+    aggregate_cursor,
+    get_shadow_columns,
+    get_shadow_values,
+    get_update_spec,
+    logger,
+    safe_regex)
 
 
 OPERATORS_MAP = {
@@ -66,6 +72,74 @@ OPERATORS_MAP = {
     'year': lambda val: {'$gte': val[0], '$lt': val[1]},
 }
 
+# Lookups whose operator functions need the actual lookup value, so
+# they are applied when binding values to a cached filter template.
+REGEX_LOOKUPS = ('iexact', 'startswith', 'istartswith', 'endswith',
+                 'iendswith', 'contains', 'icontains', 'regex', 'iregex')
+
+# Case-insensitive lookups and the lookups that replace them on the
+# lowercase shadow columns of the case_insensitive_fields model option.
+CASE_SENSITIVE_LOOKUPS = {
+    'iexact':      'exact',
+    'istartswith': 'startswith',
+    'iendswith':   'endswith',
+    'icontains':   'contains',
+}
+
+# Comparison operators for filters on F() expressions.
+EXPR_OPERATORS = {
+    'exact': '$eq',
+    'gt':    '$gt',
+    'gte':   '$gte',
+    'lt':    '$lt',
+    'lte':   '$lte',
+}
+
+# Aggregation operators for the arithmetic connectors of F() expressions.
+EXPRESSION_OPERATORS = {
+    ExpressionNode.ADD: '$add',
+    ExpressionNode.SUB: '$subtract',
+    ExpressionNode.MUL: '$multiply',
+    ExpressionNode.DIV: '$divide',
+    ExpressionNode.MOD: '$mod',
+}
+
+# Aggregation operators for the date part lookups, see DATE_PARTS.
+DATE_PART_OPERATORS = {
+    'month':    '$month',
+    'day':      '$dayOfMonth',
+    'week_day': '$dayOfWeek',
+    'hour':     '$hour',
+    'minute':   '$minute',
+    'second':   '$second',
+}
+
+# Update operators for .update(foo=F('foo') <connector> value).
+UPDATE_OPERATORS = {
+    ExpressionNode.ADD: '$inc',
+    ExpressionNode.SUB: '$inc',
+    ExpressionNode.MUL: '$mul',
+}
+
+# Aggregation stages after which documents don't have the model's
+# fields anymore, see MongoQuery.translate_pipeline.
+RESHAPING_STAGES = ('$group', '$project', '$replaceRoot', '$replaceWith',
+                    '$bucket', '$bucketAuto', '$facet', '$count',
+                    '$sortByCount')
+
+# Stages writing the results of an aggregation to a collection.
+OUTPUT_STAGES = ('$out', '$merge')
+
+HAVING_OPERATORS = ('exact', 'gt', 'gte', 'lt', 'lte', 'in', 'range',
+                    'isnull')
+
+LOWER_BOUNDS = ('$gt', '$gte')
+UPPER_BOUNDS = ('$lt', '$lte')
+
+# Operators of negated conditions that exclude values, see
+# merge_conditions.
+EXCLUDING_OPERATORS = ('$ne', '$nin', '$not')
+
 NEGATED_OPERATORS_MAP = {
     'exact':  lambda val: {'$ne': val},
     'gt':     lambda val: {'$lte': val},
@@ -77,15 +151,296 @@ NEGATED_OPERATORS_MAP = {
 }
 
 
+# Translated filters, keyed by model and shape of the WHERE tree.
+filter_cache = LRUCache(getattr(settings, 'MONGODB_FILTER_CACHE_SIZE', 1000))
+
+_UNCACHEABLE = object()
+
+
+class FilterParam(object):
+    """
+    Placeholder for the `index`-th lookup value in a cached filter
+    template, optionally transformed by `func` when bound.
+    """
+
+    def __init__(self, index, func=None):
+        self.index = index
+        self.func = func
+
+    def __getitem__(self, item):
+        # Used by lookups taking two values, like 'range'.
+        return self.transform(lambda value: value[item])
+
+    def transform(self, func):
+        """
+        Returns a placeholder for the value of this one transformed by
+        `func`.
+        """
+        if self.func is None:
+            return FilterParam(self.index, func)
+        return FilterParam(self.index,
+                           lambda value: func(self.func(value)))
+
+    def bind(self, values):
+        value = values[self.index]
+        if self.func is not None:
+            value = self.func(value)
+        return value
+
+
+def bind_filter_params(spec, values):
+    """
+    Returns a copy of the filter template `spec` with all
+    :class:`FilterParam` placeholders replaced by `values`.
+    """
+    if isinstance(spec, FilterParam):
+        return spec.bind(values)
+    if isinstance(spec, dict):
+        return dict((key, bind_filter_params(value, values))
+                    for key, value in spec.iteritems())
+    if isinstance(spec, list):
+        return [bind_filter_params(value, values) for value in spec]
+    return spec
+
+
+def is_operator_dict(value):
+    """
+    Returns whether the condition `value` is a dict of query operators
+    (like ``{'$gt': 1}``) rather than a value to compare to.
+    """
+    return isinstance(value, dict) and \
+        any(key.startswith('$') for key in value)
+
+
+def get_values(values):
+    """
+    Returns the list `values` of an ``$in``, ``$nin`` or ``$all``
+    operator.
+    """
+    if isinstance(values, FilterParam):
+        # Can't be merged into a template, the length isn't known.
+        raise TypeError("Can't merge placeholder %r." % values)
+    return list(values)
+
+
+def get_excluded(operator, value):
+    """
+    Returns the list of values excluded by the negated condition
+    ``{operator: value}``, or ``None`` if it doesn't exclude values.
+    """
+    if operator == '$nin':
+        return get_values(value)
+    if operator == '$ne' or (operator == '$not' and
+                             not is_operator_dict(value)):
+        return [value]
+
+
+def merge_bound(condition, operator, value):
+    """
+    Adds the bound ``{operator: value}`` to the dict of operators
+    `condition`, keeping only the tighter one of two lower (or upper)
+    bounds.
+    """
+    bounds = LOWER_BOUNDS if operator in LOWER_BOUNDS else UPPER_BOUNDS
+    existing = [key for key in bounds if key in condition]
+    if not existing:
+        condition[operator] = value
+        return
+    existing_operator = existing[0]
+    existing_value = condition[existing_operator]
+    if isinstance(value, FilterParam) or \
+       isinstance(existing_value, FilterParam):
+        raise TypeError("Can't compare placeholders.")
+    if value == existing_value:
+        # Exclusive bounds ($gt, $lt) are the tighter ones.
+        if operator != bounds[0]:
+            return
+    elif (value > existing_value) != (bounds is LOWER_BOUNDS):
+        return
+    del condition[existing_operator]
+    condition[operator] = value
+
+
+def merge_conditions(existing, new):
+    """
+    Returns a condition on a field matching the values that match both
+    the `existing` and the `new` condition (or ``None`` if they can't
+    be combined into one), e.g.::
+
+        {'$gt': 1} + {'$lt': 5} --> {'$gt': 1, '$lt': 5}
+        {'$gt': 1} + {'$gte': 3} --> {'$gte': 3}
+        {'$ne': 1} + {'$not': re} --> {'$nin': [1, re]}
+        o1 + o2 --> {'$all': [o1, o2]}
+    """
+    if not is_operator_dict(existing):
+        existing = {'$all': [existing]}
+    if not is_operator_dict(new):
+        new = {'$all': [new]}
+    merged = dict(existing)
+    for operator, value in new.iteritems():
+        if operator in LOWER_BOUNDS + UPPER_BOUNDS:
+            merge_bound(merged, operator, value)
+            continue
+
+        excluded = get_excluded(operator, value)
+        if excluded is not None:
+            for key in EXCLUDING_OPERATORS:
+                if key in merged:
+                    existing_excluded = get_excluded(key, merged[key])
+                    if existing_excluded is None:
+                        return None
+                    del merged[key]
+                    excluded = existing_excluded + excluded
+            if len(excluded) == 1:
+                merged[operator] = value
+            else:
+                merged['$nin'] = excluded
+        elif operator not in merged:
+            merged[operator] = value
+        elif operator == '$all':
+            merged['$all'] = get_values(merged['$all']) + get_values(value)
+        else:
+            return None
+    return merged
+
+
+def add_condition(query, column, condition):
+    """
+    ANDs the `condition` on `column` into `query`, falling back to
+    ``$and`` if it can't be merged with an existing condition.
+    """
+    if column not in query:
+        query[column] = condition
+        return
+    merged = merge_conditions(query[column], condition)
+    if merged is None:
+        query.setdefault('$and', []).append({column: condition})
+    else:
+        query[column] = merged
+
+
+def add_expr(query, condition):
+    """
+    ANDs the aggregation expression `condition` into the ``$expr`` of
+    `query`.
+    """
+    existing = query.get('$expr')
+    if existing is None:
+        query['$expr'] = condition
+    elif existing.keys() == ['$and']:
+        existing['$and'].append(condition)
+    else:
+        query['$expr'] = {'$and': [existing, condition]}
+
+
+def merge_queries(query, other):
+    """
+    ANDs the translated filters `other` into `query`.
+    """
+    for key, value in other.iteritems():
+        if key in ('$and', '$nor'):
+            query.setdefault(key, []).extend(value)
+        elif key == '$or':
+            if '$or' in query:
+                query.setdefault('$and', []).append({'$or': value})
+            else:
+                query['$or'] = value
+        elif key == '$expr':
+            add_expr(query, value)
+        else:
+            add_condition(query, key, value)
+
+
+def fold_or(branches):
+    """
+    Returns a query matching any of the translated filters `branches`,
+    folding equality conditions on the same field into ``$in``::
+
+        [{'a': 1}, {'a': {'$in': [2, 3]}}, {'b': 4}] -->
+            {'$or': [{'a': {'$in': [1, 2, 3]}}, {'b': 4}]}
+    """
+    columns = []
+    for branch in branches:
+        column = None
+        if len(branch) == 1:
+            key, value = branch.items()[0]
+            if not key.startswith('$') and (
+                    not is_operator_dict(value) or value.keys() == ['$in']):
+                column = key
+        columns.append(column)
+
+    folded = []
+    in_values = {}
+    for column, branch in zip(columns, branches):
+        if column is None or columns.count(column) == 1:
+            folded.append(branch)
+            continue
+        if column not in in_values:
+            in_values[column] = []
+            folded.append({column: {'$in': in_values[column]}})
+        value = branch[column]
+        if is_operator_dict(value):
+            in_values[column].extend(get_values(value['$in']))
+        else:
+            in_values[column].append(value)
+
+    if len(folded) == 1:
+        return folded[0]
+    return {'$or': folded}
+
+
+def get_distinct_stages(opts, key):
+    """
+    Returns the aggregation stages (using field names) that prepare
+    grouping by the field `key` the way the distinct command counts its
+    values: lists are unwound into their items, and documents that lack
+    the field are left out (but ``null`` values aren't).
+
+    Unwinding with ``preserveNullAndEmptyArrays`` needs MongoDB 3.2.
+    """
+    name = key.split('.')[0]
+    try:
+        field = opts.pk if name == 'pk' else opts.get_field(name)
+    except FieldDoesNotExist:
+        field = None
+    stages = []
+    if isinstance(field, AbstractIterableField):
+        # Keep null lists; empty ones lose the field and are left out.
+        stages.append({'$unwind': {'path': '$' + name,
+                                   'preserveNullAndEmptyArrays': True}})
+    stages.append({'$match': {key: {'$exists': True}}})
+    return stages
+
+
+# Keyword argument of Collection.find that keeps idle cursors open.
+if pymongo.version_tuple >= (3,):
+    NO_TIMEOUT = {'no_cursor_timeout': True}
+else:
+    NO_TIMEOUT = {'timeout': False}
+
+
+def reraise_pymongo_error():
+    """
+    Re-raises the PyMongo error currently being handled as the
+    corresponding Django database error.
+    """
+    exc_type, exc, traceback = sys.exc_info()
+    if isinstance(exc, DuplicateKeyError):
+        error_class = IntegrityError
+    elif isinstance(exc, ExecutionTimeout):
+        error_class = MaxTimeExceeded
+    else:
+        error_class = DatabaseError
+    raise error_class, error_class(smart_str(exc)), traceback
+
+
 def safe_call(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
         try:
             return func(*args, **kwargs)
-        except DuplicateKeyError, e:
-            raise IntegrityError, IntegrityError(smart_str(e)), sys.exc_info()[2]
-        except PyMongoError, e:
-            raise DatabaseError, DatabaseError(smart_str(e)), sys.exc_info()[2]
+        except PyMongoError:
+            reraise_pymongo_error()
     return wrapper
 
 
@@ -96,16 +451,30 @@ class MongoQuery(NonrelQuery):
         self.ordering = []
         self.collection = self.compiler.get_collection()
         self.mongo_query = getattr(compiler.query, 'raw_query', {})
+        # Per-queryset options, see contrib.MongoDBQuerySet.
+        self.options = getattr(compiler.query, 'mongo_options', {})
+        self.max_time_ms = self.options.get('max_time_ms',
+                                            self.connection.max_time_ms)
 
     def __repr__(self):
         return '<MongoQuery: %r ORDER %r>' % (self.mongo_query, self.ordering)
 
     def fetch(self, low_mark, high_mark):
+        if self.connection.query_plan_checks is not None:
+            self.check_query_plan(**self.connection.query_plan_checks)
         results = self.get_cursor()
         pk_column = self.query.get_meta().pk.column
-        for entity in results:
-            entity[pk_column] = entity.pop('_id')
-            yield entity
+        try:
+            for entity in results:
+                if '_id' in entity:
+                    entity[pk_column] = entity.pop('_id')
+                yield entity
+        except PyMongoError:
+            reraise_pymongo_error()
+        finally:
+            # Free the server-side cursor if iteration stops early.
+            if hasattr(results, 'close'):
+                results.close()
 
     @safe_call
     def count(self, limit=None):
@@ -128,15 +497,24 @@ class MongoQuery(NonrelQuery):
 
     @safe_call
     def delete(self):
-        options = self.connection.operation_flags.get('delete', {})
+        options = self.compiler.get_write_options('delete')
         self.collection.remove(self.mongo_query, **options)
 
     def get_cursor(self):
         if self.query.low_mark == self.query.high_mark:
             return []
 
-        fields = get_selected_fields(self.query)
-        cursor = self.collection.find(self.mongo_query, fields)
+        fields = self.get_projection()
+        kwargs = {}
+        if self.options.get('no_timeout'):
+            kwargs.update(NO_TIMEOUT)
+        cursor = self.collection.find(self.mongo_query, fields, **kwargs)
+        if self.options.get('batch_size'):
+            cursor.batch_size(self.options['batch_size'])
+        if self.options.get('hint'):
+            cursor.hint(self.options['hint'])
+        if self.max_time_ms:
+            cursor.max_time_ms(self.max_time_ms)
         if self.ordering:
             cursor.sort(self.ordering)
         if self.query.low_mark > 0:
@@ -145,145 +523,517 @@ class MongoQuery(NonrelQuery):
             cursor.limit(int(self.query.high_mark - self.query.low_mark))
         return cursor
 
-    def add_filters(self, filters, query=None):
-        children = self._get_children(filters.children)
-
-        if query is None:
-            query = self.mongo_query
-
-        if filters.connector == OR:
-            assert '$or' not in query, "Multiple ORs are not supported."
-            or_conditions = query['$or'] = []
-
-        if filters.negated:
-            self._negated = not self._negated
+    @safe_call
+    def distinct(self, key):
+        if not self.options.get('hint'):
+            return self.get_cursor().distinct(self._translate_path(key))
+        # The distinct command doesn't take a hint, so use an aggregation
+        # that counts values the way distinct does (needs MongoDB 3.6).
+        stages = get_distinct_stages(self.query.get_meta(), key)
+        stages.append({'$group': {'_id': '$' + key}})
+        pipeline = [{'$match': self.mongo_query}]
+        pipeline.extend(self.translate_pipeline(stages))
+        return [result['_id'] for result in aggregate_cursor(
+            self.collection, pipeline, **self.get_aggregate_options())]
 
-        for child in children:
-            if filters.connector == OR:
-                subquery = {}
+    @safe_call
+    def aggregate_pipeline(self, stages, allow_disk_use=False):
+        """
+        Runs the aggregation pipeline `stages` on the documents matched
+        by the query, in the query's order and slice, and returns an
+        iterator over the resulting documents -- or ``None`` if the
+        pipeline writes them to a collection (see OUTPUT_STAGES).
+        """
+        stages = self.translate_pipeline(stages)
+        writes = bool(stages) and stages[-1].keys()[0] in OUTPUT_STAGES
+        if self.query.low_mark == self.query.high_mark:
+            if not writes:
+                return iter([])
+            # The output stage still has to replace (or merge into) its
+            # target collection, so run it on no documents.
+            pipeline = [{'$match': {'_id': {'$exists': False}}}]
+        else:
+            pipeline = []
+            if self.mongo_query:
+                pipeline.append({'$match': self.mongo_query})
+            # Aggregations don't support sorting by $natural.
+            ordering = [(column, direction) for column, direction
+                        in self.ordering if column != '$natural']
+            if ordering:
+                pipeline.append({'$sort': SON(ordering)})
+            if self.query.low_mark > 0:
+                pipeline.append({'$skip': self.query.low_mark})
+            if self.query.high_mark is not None:
+                pipeline.append({'$limit': int(self.query.high_mark -
+                                               self.query.low_mark)})
+        pipeline.extend(stages)
+
+        options = self.get_aggregate_options()
+        if allow_disk_use:
+            options['allowDiskUse'] = True
+        cursor = aggregate_cursor(self.collection, pipeline, **options)
+        if writes:
+            cursor.close()
+            return None
+        return self._iter_cursor(cursor)
+
+    def _iter_cursor(self, cursor):
+        try:
+            for result in cursor:
+                yield result
+        except PyMongoError:
+            reraise_pymongo_error()
+        finally:
+            # Free the server-side cursor if iteration stops early.
+            cursor.close()
+
+    def translate_pipeline(self, stages):
+        """
+        Returns a copy of the aggregation pipeline `stages` with field
+        names translated to column names: in field paths (like
+        ``'$pk'``) and the keys of ``$match``, ``$sort`` and
+        ``$project`` stages, up to the first stage that reshapes the
+        documents (see RESHAPING_STAGES). Models given as targets of
+        ``$out`` and ``$merge`` stages are replaced by their
+        collection names.
+        """
+        pipeline = []
+        reshaped = False
+        for stage in stages:
+            [(name, value)] = stage.items()
+            if name in OUTPUT_STAGES:
+                value = self._translate_output(value)
+            elif reshaped:
+                pass
+            elif name == '$match':
+                value = self._translate_match(value)
+            elif name in ('$sort', '$project'):
+                value = type(value)(
+                    (self._translate_path(key),
+                     self._translate_field_paths(item))
+                    for key, item in value.items())
             else:
-                subquery = query
+                value = self._translate_field_paths(value)
+            pipeline.append({name: value})
+            reshaped = reshaped or name in RESHAPING_STAGES
+        return pipeline
+
+    def _translate_path(self, path):
+        # 'name.foo' --> 'column.foo', 'pk' --> '_id'
+        opts = self.query.get_meta()
+        parts = path.split('.')
+        if parts[0] == 'pk':
+            parts[0] = '_id'
+        else:
+            try:
+                field = opts.get_field(parts[0])
+            except FieldDoesNotExist:
+                return path
+            parts[0] = '_id' if field.primary_key else field.column
+        return '.'.join(parts)
+
+    def _translate_field_paths(self, value):
+        if isinstance(value, basestring):
+            if value.startswith('$') and not value.startswith('$$'):
+                return '$' + self._translate_path(value[1:])
+            return value
+        if isinstance(value, dict):
+            return type(value)((key, self._translate_field_paths(item))
+                               for key, item in value.items())
+        if isinstance(value, (list, tuple)):
+            return [self._translate_field_paths(item) for item in value]
+        return value
+
+    def _translate_match(self, query):
+        translated = type(query)()
+        for key, value in query.items():
+            if key in ('$and', '$or', '$nor'):
+                value = [self._translate_match(item) for item in value]
+            elif key == '$expr':
+                value = self._translate_field_paths(value)
+            elif not key.startswith('$'):
+                key = self._translate_path(key)
+            translated[key] = value
+        return translated
+
+    def _translate_output(self, target):
+        # {'$out': Model} --> {'$out': 'app_model'}
+        if isinstance(target, dict):
+            target = target.copy()
+            if 'into' in target:
+                target['into'] = self._translate_output(target['into'])
+            return target
+        if isinstance(target, type):
+            return target._meta.db_table
+        return target
+
+    def get_aggregate_options(self):
+        """
+        Returns the keyword arguments for :func:`aggregate_cursor` that
+        apply the query's options to aggregations.
+        """
+        options = {'batch_size': self.options.get('batch_size')}
+        if self.max_time_ms:
+            options['maxTimeMS'] = self.max_time_ms
+        if self.options.get('hint'):
+            options['hint'] = SON(self.options['hint'])
+        return options
 
-            if isinstance(child, Node):
-                if filters.connector == OR and child.connector == OR:
-                    if len(child.children) > 1:
-                        raise DatabaseError("Nested ORs are not supported.")
+    @safe_call
+    def explain(self):
+        """
+        Returns a :class:`~django_mongodb_engine.utils.QueryPlan` for the
+        query's cursor, or ``None`` for empty slices.
+        """
+        cursor = self.get_cursor()
+        if not hasattr(cursor, 'explain'):
+            return None
+        return QueryPlan(cursor.explain())
 
-                if filters.connector == OR and filters.negated:
-                    raise NotImplementedError("Negated ORs are not supported.")
+    def check_query_plan(self, action='log', threshold=0):
+        """
+        Logs a warning (or raises :class:`QueryPlanError` if `action` is
+        ``'raise'``) if the query scans the collection or sorts in
+        memory and examines at least `threshold` documents.
+        """
+        plan = self.explain()
+        if plan is None or not (plan.collection_scan or plan.in_memory_sort):
+            return
+        if (plan.docs_examined or 0) < threshold:
+            return
+        msg = "Query %r on %s %s (%s documents examined)." % (
+            self.mongo_query, self.collection.name,
+            'scans the collection' if plan.collection_scan
+            else 'sorts in memory by %r' % (self.ordering,),
+            plan.docs_examined)
+        if action == 'raise':
+            raise QueryPlanError(msg)
+        logger.warning(msg)
+
+    def get_projection(self):
+        """
+        Returns the projection passed to :meth:`Collection.find
+        <pymongo.collection.Collection.find>` to only load the fields
+        selected by ``only()``, ``defer()``, ``values()`` or
+        ``values_list()``, or ``None`` to load whole documents.
+
+        The ``'embedded_fields'`` and ``'slices'`` options (see
+        :class:`~django_mongodb_engine.contrib.MongoDBQuerySet`)
+        restrict the projection to parts of embedded models and lists.
+        """
+        if self.fields is None:
+            return None
+        embedded = self.options.get('embedded_fields', {})
+        slices = self.options.get('slices', {})
+        columns = ['_id' if field.primary_key else field.column
+                   for field in self.fields]
+
+        if len(self.fields) == len(self.query.get_meta().fields) and \
+           not embedded:
+            # A projection of only $slices loads all other fields, too.
+            if not slices:
+                return None
+            return dict((column, {'$slice': value})
+                        for column, value in slices.iteritems())
+
+        projection = {}
+        for column in columns:
+            if column in embedded:
+                for path in embedded[column]:
+                    projection['%s.%s' % (column, path)] = 1
+            elif column in slices:
+                projection[column] = {'$slice': slices[column]}
+            else:
+                projection[column] = 1
+        if '_id' not in projection:
+            # Needs to be excluded explicitly, allowing for covered
+            # queries.
+            projection['_id'] = 0
+        return projection
+
+    def add_filters(self, filters):
+        """
+        Translates the WHERE tree `filters` into `self.mongo_query`.
 
-                self.add_filters(child, query=subquery)
+        Trees of the same shape (same fields, lookup types, connectors
+        and negations) translate to the same MongoDB query, only with
+        different values. Translations are cached in `filter_cache` as
+        templates that hold :class:`FilterParam` placeholders in place
+        of the values, so the tree only has to be translated once.
+        """
+        leaves = []
+        shape = self._get_filter_shape(filters, leaves)
+        if shape is None or self.mongo_query or not filter_cache.max_size:
+            # Raw queries are merged with the filters, so they can't
+            # use the cache either.
+            self._translate_filters(filters, leaves)
+            return
+
+        key = self.query.model, shape
+        template = filter_cache.get(key)
+        if template is None:
+            params = [(field, lookup_type, value if lookup_type == 'isnull'
+                       else FilterParam(index))
+                      for index, (field, lookup_type, value)
+                      in enumerate(leaves)]
+            template = {}
+            try:
+                self._translate_filters(filters, params, template)
+            except TypeError:
+                # Some translations (like merging two bounds on the
+                # same field) need the actual values.
+                template = _UNCACHEABLE
+            filter_cache.set(key, template)
+
+        if template is _UNCACHEABLE:
+            self._translate_filters(filters, leaves)
+        else:
+            values = [value for _, _, value in leaves]
+            self.mongo_query.update(bind_filter_params(template, values))
 
-                if filters.connector == OR and subquery:
-                    or_conditions.extend(subquery.pop('$or', []))
-                    if subquery:
-                        or_conditions.append(subquery)
+    def _get_filter_shape(self, filters, leaves):
+        """
+        Decodes all leaves of `filters`, appending them to `leaves` in
+        translation order, and returns a hashable representation of
+        the tree's shape (or ``None`` if it can't be cached).
+        """
+        shape = [filters.connector, filters.negated]
+        cacheable = True
+        for child in self._get_children(filters.children):
+            if isinstance(child, Node):
+                child_shape = self._get_filter_shape(child, leaves)
+                cacheable = cacheable and child_shape is not None
+            else:
+                field, lookup_type, value = self._decode_child(child)
+                leaves.append((field, lookup_type, value))
+                # Dict values are merged into the query, A() queries
+                # change the key and F() expressions aren't parameters,
+                # so the query's structure depends on the value.
+                if isinstance(value, (dict, A, SQLEvaluator)):
+                    cacheable = False
+                # Date parts of datetimes are in the current time zone.
+                if lookup_type in DATE_PART_OPERATORS and settings.USE_TZ:
+                    cacheable = False
+                child_shape = (field.column, lookup_type,
+                               value if lookup_type == 'isnull' else None)
+            shape.append(child_shape)
+        if cacheable:
+            return tuple(shape)
+
+    def _translate_filters(self, filters, leaves, query=None):
+        """
+        Translates `filters` into `query` (`self.mongo_query` by
+        default), taking the decoded leaves from the list `leaves`.
+        """
+        if query is None:
+            query = self.mongo_query
+        self._leaves = iter(leaves)
+        self._add_filters(filters, query)
 
-                continue
+    def _add_filters(self, filters, query, negated=False):
+        """
+        ANDs the WHERE tree `filters` (negated if `negated` is true)
+        into `query`.
+
+        ANDs are flattened into `query` and ORs become ``$or`` (folding
+        equality conditions on the same field into ``$in``). Negations
+        are pushed down to single conditions where possible, so that
+        ``NOT (a OR b)`` becomes ``NOT a AND NOT b``; only negated ANDs
+        of several conditions are translated to ``$nor``.
+        """
+        negated = negated != filters.negated
+        children = self._get_children(filters.children)
 
-            field, lookup_type, value = self._decode_child(child)
+        if filters.connector == OR and not negated and len(children) > 1:
+            branches = []
+            matches_all = False
+            for child in children:
+                branch = {}
+                self._add_child(child, branch)
+                if branch.keys() == ['$or']:
+                    # a OR (b OR c) --> a OR b OR c
+                    branches.extend(branch['$or'])
+                elif branch:
+                    branches.append(branch)
+                else:
+                    # A branch matching everything makes the whole OR
+                    # match everything (the remaining children still
+                    # have to be consumed).
+                    matches_all = True
+            if branches and not matches_all:
+                merge_queries(query, fold_or(branches))
+        elif filters.connector != OR and negated and len(children) > 1:
+            # NOT (a AND b) --> {'$nor': [{a, b}]}
+            subquery = {}
+            for child in children:
+                self._add_child(child, subquery)
+            if subquery:
+                merge_queries(query, {'$nor': [subquery]})
+        else:
+            # a AND b, or NOT (a OR b) --> NOT a AND NOT b
+            for child in children:
+                self._add_child(child, query, negated)
 
-            if lookup_type in ('month', 'day'):
-                raise DatabaseError("MongoDB does not support month/day "
-                                    "queries.")
-            if self._negated and lookup_type == 'range':
-                raise DatabaseError("Negated range lookups are not "
-                                    "supported.")
+    def _add_child(self, child, query, negated=False):
+        if isinstance(child, Node):
+            self._add_filters(child, query, negated)
+            return
 
-            if field.primary_key:
-                column = '_id'
-            else:
-                column = field.column
+        field, lookup_type, value = self._leaves.next()
 
-            existing = subquery.get(column)
+        if field.primary_key:
+            column = '_id'
+        else:
+            column = field.column
+
+        if isinstance(value, SQLEvaluator):
+            self._add_expr_filter(query, column, lookup_type,
+                                  value.expression, negated)
+            return
+
+        if lookup_type in DATE_PART_OPERATORS:
+            self._add_date_part_filter(query, field, lookup_type, value,
+                                       negated)
+            return
+
+        if isinstance(value, A):
+            column, value = value.as_q(field)
+        elif lookup_type in CASE_SENSITIVE_LOOKUPS:
+            column, lookup_type, value = self._get_case_insensitive_lookup(
+                field, column, lookup_type, value)
+
+        if negated and lookup_type in NEGATED_OPERATORS_MAP:
+            op_func = NEGATED_OPERATORS_MAP[lookup_type]
+        else:
+            op_func = OPERATORS_MAP[lookup_type]
 
-            if isinstance(value, A):
-                column, value = value.as_q(field)
+        if isinstance(value, FilterParam) and lookup_type in REGEX_LOOKUPS:
+            condition = value.transform(op_func)
+        else:
+            condition = op_func(value)
 
-            if self._negated and lookup_type in NEGATED_OPERATORS_MAP:
-                op_func = NEGATED_OPERATORS_MAP[lookup_type]
-                already_negated = True
-            else:
-                op_func = OPERATORS_MAP[lookup_type]
-                if self._negated:
-                    already_negated = False
-
-            lookup = op_func(value)
-
-            if existing is None:
-                if self._negated and not already_negated:
-                    lookup = {'$not': lookup}
-                subquery[column] = lookup
-                if filters.connector == OR and subquery:
-                    or_conditions.append(subquery)
-                continue
+        if negated and lookup_type not in NEGATED_OPERATORS_MAP:
+            condition = {'$not': condition}
+        add_condition(query, column, condition)
 
-            if not isinstance(existing, dict):
-                if not self._negated:
-                    # {'a': o1} + {'a': o2} --> {'a': {'$all': [o1, o2]}}
-                    assert not isinstance(lookup, dict)
-                    subquery[column] = {'$all': [existing, lookup]}
+    def _get_case_insensitive_lookup(self, field, column, lookup_type,
+                                     value):
+        """
+        Returns a ``(column, lookup_type, value)`` tuple for a
+        case-insensitive lookup that can use an index: a case-sensitive
+        lookup on the field's lowercase shadow column (if it is one of
+        the model's ``case_insensitive_fields``), an ``exact`` lookup
+        for ``iexact`` if the model's collection has a case-insensitive
+        ``collation``, or the original lookup.
+        """
+        opts = self.query.get_meta()
+        for shadow_field, name, shadow_column in get_shadow_columns(opts):
+            if shadow_field == field and name == 'lower':
+                if isinstance(value, FilterParam):
+                    value = value.transform(lambda value: value.lower())
                 else:
-                    # {'a': o1} + {'a': {'$not': o2}} -->
-                    #     {'a': {'$all': [o1], '$nin': [o2]}}
-                    if already_negated:
-                        assert lookup.keys() == ['$ne']
-                        lookup = lookup['$ne']
-                    assert not isinstance(lookup, dict)
-                    subquery[column] = {'$all': [existing], '$nin': [lookup]}
+                    value = value.lower()
+                return (shadow_column, CASE_SENSITIVE_LOOKUPS[lookup_type],
+                        value)
+
+        collation = getattr(opts, 'collation', None)
+        # Collation objects of PyMongo 3.4+ or dicts.
+        collation = getattr(collation, 'document', collation) or {}
+        if (lookup_type == 'iexact' and collation.get('strength') == 2 and
+                not collation.get('caseLevel')):
+            return column, 'exact', value
+        return column, lookup_type, value
+
+    def _add_expr_filter(self, query, column, lookup_type, expression,
+                         negated=False):
+        """
+        Adds a filter comparing the field `column` to the F() expression
+        `expression`, e.g. ``filter(a__gt=F('b') + 1)`` -->
+        ``{'$expr': {'$gt': ['$a', {'$add': ['$b', 1]}]}}``.
+        """
+        try:
+            operator = EXPR_OPERATORS[lookup_type]
+        except KeyError:
+            raise DatabaseError("Lookup type %r isn't supported with F() "
+                                "expressions." % lookup_type)
+        condition = {operator: ['$' + column,
+                                self.get_expression(expression)]}
+        if negated:
+            condition = {'$not': [condition]}
+        add_expr(query, condition)
+
+    def _add_date_part_filter(self, query, field, lookup_type, value,
+                              negated=False):
+        """
+        Adds a filter on a part of the date `field`, using its shadow
+        column if the part is listed in the model's ``date_parts``,
+        e.g. ``filter(date__month=3)`` --> ``{'date__month': 3}``, or
+        ``{'$expr': {'$eq': [{'$month': '$date'}, 3]}}`` otherwise.
+
+        Like Django, parts of datetimes are looked up in the current
+        time zone if ``USE_TZ`` is enabled. Shadow columns hold them in
+        the default one, so they are only used while it's the current.
+        """
+        aware = settings.USE_TZ and \
+            field.get_internal_type() == 'DateTimeField'
+        if not aware or timezone.get_current_timezone_name() == \
+                timezone.get_default_timezone_name():
+            opts = self.query.get_meta()
+            for shadow_field, part, column in get_shadow_columns(opts):
+                if shadow_field == field and part == lookup_type:
+                    add_condition(query, column,
+                                  {'$ne': value} if negated else value)
+                    return
+
+        date = '$' + field.column
+        if aware:
+            date = {'date': date,
+                    'timezone': timezone.get_current_timezone_name()}
+        condition = {'$eq': [{DATE_PART_OPERATORS[lookup_type]: date},
+                             value]}
+        if negated:
+            condition = {'$not': [condition]}
+        add_expr(query, condition)
+
+    def get_expression(self, expression):
+        """
+        Translates the F() expression `expression` to an aggregation
+        expression.
+        """
+        if isinstance(expression, F):
+            opts = self.query.get_meta()
+            if expression.name == 'pk':
+                field = opts.pk
             else:
-                not_ = existing.pop('$not', None)
-                if not_:
-                    assert not existing
-                    if isinstance(lookup, dict):
-                        assert lookup.keys() == ['$ne']
-                        lookup = lookup.values()[0]
-                    assert not isinstance(lookup, dict), (not_, lookup)
-                    if self._negated:
-                        # {'not': {'a': o1}} + {'a': {'not': o2}} -->
-                        #     {'a': {'nin': [o1, o2]}}
-                        subquery[column] = {'$nin': [not_, lookup]}
-                    else:
-                        # {'not': {'a': o1}} + {'a': o2} -->
-                        #     {'a': {'nin': [o1], 'all': [o2]}}
-                        subquery[column] = {'$nin': [not_], '$all': [lookup]}
-                else:
-                    if isinstance(lookup, dict):
-                        if '$ne' in lookup:
-                            if '$nin' in existing:
-                                # {'$nin': [o1, o2]} + {'$ne': o3} -->
-                                #     {'$nin': [o1, o2, o3]}
-                                assert '$ne' not in existing
-                                existing['$nin'].append(lookup['$ne'])
-                            elif '$ne' in existing:
-                                # {'$ne': o1} + {'$ne': o2} -->
-                                #    {'$nin': [o1, o2]}
-                                existing['$nin'] = [existing.pop('$ne'),
-                                                    lookup['$ne']]
-                            else:
-                                existing.update(lookup)
-                        else:
-                            if '$in' in lookup and '$in' in existing:
-                                # {'$in': o1} + {'$in': o2}
-                                #    --> {'$in': o1 union o2}
-                                existing['$in'] = list(
-                                    set(lookup['$in'] + existing['$in']))
-                            else:
-                                # {'$gt': o1} + {'$lt': o2}
-                                #    --> {'$gt': o1, '$lt': o2}
-                                assert all(key not in existing
-                                           for key in lookup.keys()), \
-                                       [lookup, existing]
-                                existing.update(lookup)
-                    else:
-                        key = '$nin' if self._negated else '$all'
-                        existing.setdefault(key, []).append(lookup)
-
-                if filters.connector == OR and subquery:
-                    or_conditions.append(subquery)
-
-        if filters.negated:
-            self._negated = not self._negated
+                try:
+                    field = opts.get_field(expression.name)
+                except Exception:
+                    raise DatabaseError("Can't use F(%r): Only fields of %s "
+                                        "can be referenced." %
+                                        (expression.name, opts.object_name))
+            return '$_id' if field.primary_key else '$' + field.column
+        if not isinstance(expression, ExpressionNode):
+            if isinstance(expression, basestring):
+                return {'$literal': expression}
+            if isinstance(expression, datetime.timedelta):
+                # Dates are added to and subtracted from in milliseconds.
+                return (expression.days * 86400000 +
+                        expression.seconds * 1000 +
+                        expression.microseconds // 1000)
+            return expression
+
+        try:
+            operator = EXPRESSION_OPERATORS[expression.connector]
+        except KeyError:
+            raise DatabaseError("%r expressions aren't supported." %
+                                expression.connector)
+        args = [self.get_expression(child) for child in expression.children]
+        if operator in ('$add', '$multiply'):
+            return {operator: args}
+        result = args[0]
+        for arg in args[1:]:
+            result = {operator: [result, arg]}
+        return result
 
 
 class SQLCompiler(NonrelCompiler):
@@ -293,17 +1043,39 @@ class SQLCompiler(NonrelCompiler):
     query_class = MongoQuery
 
     def get_collection(self):
-        return self.connection.get_collection(self.query.get_meta().db_table)
+        """
+        Returns the query's collection, routing reads according to the
+        queryset's or the model's read preference (if any).
+        """
+        meta = self.query.get_meta()
+        read_preference = getattr(self.query, 'mongo_options', {}).get(
+            'read_preference', getattr(meta, 'read_preference', None))
+        return self.connection.get_collection(
+            meta.db_table, read_preference=read_preference)
 
+    def get_write_options(self, operation):
+        """
+        Returns the keyword arguments for the PyMongo call doing the
+        Django `operation`, including the queryset's write concern.
+        """
+        write_concern = getattr(self.query, 'mongo_options', {}).get(
+            'write_concern')
+        return self.connection.get_write_options(
+            operation, self.query.model, write_concern)
+
+    @safe_call
     def execute_sql(self, result_type=MULTI):
         """
         Handles aggregate/count queries.
+
+        All aggregates are computed by a single aggregation pipeline:
+        a ``$match`` stage for the query's filters followed by a
+        ``$group`` stage (and a ``$project`` stage for aggregates that
+        need post-processing, like distinct counts).
         """
-        collection = self.get_collection()
         aggregations = self.query.aggregate_select.items()
 
-        if len(aggregations) == 1 and isinstance(aggregations[0][1],
-                                                 sqlaggregates.Count):
+        if len(aggregations) == 1 and self._is_count(aggregations[0][1]):
             # Ne need for full-featured aggregation processing if we
             # only want to count().
             if result_type is MULTI:
@@ -311,54 +1083,260 @@ class SQLCompiler(NonrelCompiler):
             else:
                 return [self.get_count()]
 
-        counts, reduce, finalize, order, initial = [], [], [], [], {}
         try:
             query = self.build_query()
         except EmptyResultSet:
             return []
 
-        for alias, aggregate in aggregations:
-            assert isinstance(aggregate, sqlaggregates.Aggregate)
-            if isinstance(aggregate, sqlaggregates.Count):
-                order.append(None)
-                # Needed to keep the iteration order which is important
-                # in the returned value.
-                # XXX: This actually does a separate query... performance?
-                counts.append(self.get_count())
-                continue
+        pipeline = []
+        if query.mongo_query:
+            pipeline.append({'$match': query.mongo_query})
+        stages, mongo_aggregates = self._get_group_stages(None, aggregations)
+        pipeline.extend(stages)
+        # Make Django resolve the results using the MongoDB aggregates.
+        self.query.aggregates.update(mongo_aggregates)
 
-            aggregate_class = get_aggregation_class_by_name(
-                aggregate.__class__.__name__)
-            lookup = aggregate.col
-            if isinstance(lookup, tuple):
-                # lookup is a (table_name, column_name) tuple.
-                # Get rid of the table name as aggregations can't span
-                # multiple tables anyway.
-                if lookup[0] != collection.name:
-                    raise DatabaseError("Aggregations can not span multiple "
-                                        "tables (tried %r and %r)." %
-                                        (lookup[0], collection.name))
-                lookup = lookup[1]
-            self.query.aggregates[alias] = aggregate = aggregate_class(
-                alias, lookup, aggregate.source)
-            order.append(alias) # Just to keep the right order.
-            initial.update(aggregate.initial())
-            reduce.append(aggregate.reduce())
-            finalize.append(aggregate.finalize())
-
-        reduce = 'function(doc, out){ %s }' % '; '.join(reduce)
-        finalize = 'function(out){ %s }' % '; '.join(finalize)
-        cursor = collection.group(None, query.mongo_query, initial, reduce,
-                                  finalize)
+        result = next(aggregate_cursor(query.collection, pipeline,
+                                       **query.get_aggregate_options()), {})
 
         ret = []
-        for alias in order:
-            result = cursor[0][alias] if alias else counts.pop(0)
+        for alias, _ in aggregations:
+            value = result.get(alias)
             if result_type is MULTI:
-                result = [result]
-            ret.append(result)
+                value = [value]
+            ret.append(value)
         return ret
 
+    def results_iter(self):
+        """
+        Returns an iterator over the query results. Grouped queries
+        (``values(...).annotate(...)``) are run as an aggregation
+        pipeline, other queries are handled by the nonrel compiler.
+        """
+        if not self._is_grouped():
+            for row in super(SQLCompiler, self).results_iter():
+                yield row
+            return
+
+        fields = self.get_fields()
+        try:
+            query = self.build_query(fields)
+        except EmptyResultSet:
+            return
+
+        columns = [field.column for field in fields]
+        group_id = dict((field.column,
+                         '$_id' if field.primary_key else '$' + field.column)
+                        for field in fields)
+
+        # $match -> $group -> $match (HAVING) -> $sort -> $skip -> $limit
+        pipeline = []
+        if query.mongo_query:
+            pipeline.append({'$match': query.mongo_query})
+        stages, mongo_aggregates = self._get_group_stages(
+            group_id, self.query.aggregates.items())
+        pipeline.extend(stages)
+        having = self._build_having(self.query.having, dict(
+            (id(aggregate), alias)
+            for alias, aggregate in self.query.aggregates.iteritems()))
+        if having:
+            pipeline.append({'$match': having})
+        ordering = self._get_group_ordering(columns)
+        if ordering:
+            pipeline.append({'$sort': SON(ordering)})
+        if self.query.low_mark:
+            pipeline.append({'$skip': self.query.low_mark})
+        if self.query.high_mark is not None:
+            pipeline.append({'$limit': self.query.high_mark -
+                                       self.query.low_mark})
+
+        aliases = self.query.aggregate_select.keys()
+        try:
+            for result in aggregate_cursor(query.collection, pipeline,
+                                           **query.get_aggregate_options()):
+                row = self._make_result(result['_id'], fields)
+                for alias in aliases:
+                    row.append(self.query.resolve_aggregate(
+                        result.get(alias), mongo_aggregates[alias],
+                        self.connection))
+                yield row
+        except PyMongoError:
+            reraise_pymongo_error()
+
+    def check_query(self):
+        if not self._is_grouped():
+            return super(SQLCompiler, self).check_query()
+        # HAVING is supported for grouped queries (as a $match stage).
+        having, self.query.having = self.query.having, \
+            self.query.where_class()
+        try:
+            super(SQLCompiler, self).check_query()
+        finally:
+            self.query.having = having
+
+    def _get_ordering(self):
+        if self._is_grouped():
+            # Grouped queries are sorted after grouping, see
+            # _get_group_ordering.
+            return True
+        return super(SQLCompiler, self)._get_ordering()
+
+    def _is_grouped(self):
+        return bool(self.query.group_by) and bool(self.query.aggregates)
+
+    def _get_group_stages(self, group_id, aggregations):
+        """
+        Returns the ``$group`` stage (and, if needed, a ``$project``
+        stage) computing `aggregations` per distinct `group_id`, along
+        with a dict mapping aliases to the :class:`MongoAggregates
+        <django_mongodb_engine.aggregations.MongoAggregate>` used.
+        """
+        group, project, mongo_aggregates = {'_id': group_id}, {'_id': 1}, {}
+        for alias, aggregate in aggregations:
+            assert isinstance(aggregate, sqlaggregates.Aggregate)
+            aggregate_class = get_aggregation_class_by_name(
+                aggregate.__class__.__name__)
+            mongo_aggregates[alias] = aggregate = aggregate_class(
+                alias, self._get_aggregate_lookup(aggregate),
+                aggregate.source, bool(aggregate.extra.get('distinct')))
+            group[alias] = aggregate.group()
+            project[alias] = aggregate.project() or 1
+
+        stages = [{'$group': group}]
+        if any(value != 1 for value in project.itervalues()):
+            stages.append({'$project': project})
+        return stages, mongo_aggregates
+
+    def _build_having(self, node, aliases):
+        """
+        Converts the HAVING tree `node` to a query on the ``$group``
+        output. `aliases` maps the ids of aggregates to their aliases.
+        """
+        conditions = []
+        for child in node.children:
+            if isinstance(child, Node):
+                condition = self._build_having(child, aliases)
+                if not condition:
+                    continue
+            else:
+                aggregate, lookup_type, _, value = child
+                if lookup_type not in HAVING_OPERATORS:
+                    raise DatabaseError("Lookup type %r isn't supported on "
+                                        "annotations." % lookup_type)
+                value = self._convert_having_value(aggregate, lookup_type,
+                                                   value)
+                condition = {aliases[id(aggregate)]:
+                             OPERATORS_MAP[lookup_type](value)}
+            conditions.append(condition)
+
+        if not conditions:
+            return {}
+        if len(conditions) == 1:
+            spec = conditions[0]
+        else:
+            spec = {'$or' if node.connector == OR else '$and': conditions}
+        if node.negated:
+            spec = {'$nor': [spec]}
+        return spec
+
+    def _convert_having_value(self, aggregate, lookup_type, value):
+        """
+        Converts the HAVING `value` for the aggregate `aggregate`: Values
+        compared to minimums and maximums are converted like filter values
+        of the aggregated field; counts, sums and averages are numbers.
+        """
+        if lookup_type == 'isnull':
+            return value
+        aggregate_class = get_aggregation_class_by_name(
+            aggregate.__class__.__name__)
+        field = aggregate.source
+        if (aggregate_class.is_ordinal or aggregate_class.is_computed or
+                field is None):
+            if lookup_type in ('in', 'range'):
+                return [float(item) if isinstance(item, Decimal) else item
+                        for item in value]
+            return float(value) if isinstance(value, Decimal) else value
+        value = field.get_db_prep_lookup(lookup_type, value,
+                                         connection=self.connection)
+        # Undo get_db_prep_lookup putting single values in a list.
+        if lookup_type not in ('in', 'range') and \
+                isinstance(value, (list, tuple)):
+            value = value[0]
+        return self.ops.value_for_db(value, field, lookup_type)
+
+    def _get_group_ordering(self, columns):
+        """
+        Returns the ``$sort`` specification for a grouped query.
+        `columns` are the columns of the grouping fields.
+
+        Only grouping fields and annotations can be ordered by; default
+        ordering (Meta.ordering) on any other field is ignored.
+        """
+        opts = self.query.get_meta()
+        if self.query.order_by:
+            ordering, explicit = self.query.order_by, True
+        elif self.query.default_ordering:
+            ordering, explicit = opts.ordering, False
+        else:
+            return []
+
+        sort = []
+        for order in ordering:
+            if order == '?':
+                raise DatabaseError("Randomized ordering isn't supported by "
+                                    "the backend.")
+            ascending = not order.startswith('-')
+            if not self.query.standard_ordering:
+                ascending = not ascending
+            name = order.lstrip('+-')
+
+            if name in self.query.aggregates:
+                key = name
+            else:
+                field = opts.pk if name == 'pk' else opts.get_field(name)
+                if field.column in columns:
+                    key = '_id.' + field.column
+                else:
+                    if explicit:
+                        raise DatabaseError(
+                            "Grouped queries can only be ordered by "
+                            "grouping fields and annotations (got %r)." %
+                            name)
+                    continue
+            sort.append((key, ASCENDING if ascending else DESCENDING))
+        return sort
+
+    def _is_count(self, aggregate):
+        """
+        Checks whether `aggregate` is a plain count of all documents.
+        """
+        opts = self.query.get_meta()
+        return (isinstance(aggregate, sqlaggregates.Count) and
+                not aggregate.extra.get('distinct') and
+                aggregate.col in ('*', (opts.db_table, opts.pk.column)))
+
+    def _get_aggregate_lookup(self, aggregate):
+        """
+        Returns the document key to aggregate on, or ``None`` for
+        aggregates over ``*``.
+        """
+        opts = self.query.get_meta()
+        lookup = aggregate.col
+        if lookup == '*':
+            return None
+        if isinstance(lookup, tuple):
+            # lookup is a (table_name, column_name) tuple.
+            # Get rid of the table name as aggregations can't span
+            # multiple tables anyway.
+            if lookup[0] != opts.db_table:
+                raise DatabaseError("Aggregations can not span multiple "
+                                    "tables (tried %r and %r)." %
+                                    (lookup[0], opts.db_table))
+            lookup = lookup[1]
+        if lookup == opts.pk.column:
+            return '_id'
+        return lookup
+
 
 class SQLInsertCompiler(NonrelInsertCompiler, SQLCompiler):
 
@@ -372,11 +1350,14 @@ class SQLInsertCompiler(NonrelInsertCompiler, SQLCompiler):
         document is created, otherwise value for a primary key may not
         be None.
         """
+        opts = self.query.get_meta()
+        shadow_columns = get_shadow_columns(opts)
         for doc in docs:
             try:
-                doc['_id'] = doc.pop(self.query.get_meta().pk.column)
+                doc['_id'] = doc.pop(opts.pk.column)
             except KeyError:
                 pass
+            doc.update(get_shadow_values(shadow_columns, doc))
             if doc.get('_id', NOT_PROVIDED) is None:
                 if len(doc) == 1:
                     # insert with empty model
@@ -385,12 +1366,89 @@ class SQLInsertCompiler(NonrelInsertCompiler, SQLCompiler):
                     raise DatabaseError("Can't save entity with _id set to None")
 
         collection = self.get_collection()
-        options = self.connection.operation_flags.get('save', {})
 
-        if return_id:
-            return collection.save(doc, **options)
+        # bulk_create() never asks for ids and only inserts new
+        # instances. save() asks for the ids of new instances without
+        # a primary key and inserts loaded ones whose document has been
+        # deleted; new instances with a primary key are only inserted
+        # if there's no document with it, so the bulk insert is fine.
+        saving = len(docs) == 1 and (return_id or
+                                     not self.query.objs[0]._state.adding)
+        if not saving:
+            self.bulk_insert(collection, docs)
+            self.update_snapshots()
+            return
+
+        options = self.get_write_options('save')
+
+        if self.save_changes(collection, doc, options):
+            _id = doc['_id']
         else:
-            collection.save(doc, **options)
+            _id = collection.save(doc, **options)
+        self.update_snapshots()
+        if return_id:
+            return _id
+
+    def save_changes(self, collection, doc, options):
+        """
+        Saves the changes of a model instance loaded from the database
+        with ``$set`` and ``$unset`` instead of replacing the whole
+        document, if its model has the ``track_changes`` option.
+
+        Returns ``False`` if the whole document `doc` has to be saved.
+        """
+        obj = self.query.objs[0]
+        snapshot = getattr(obj, '_mongo_snapshot', None)
+        if snapshot is None or obj._state.adding or '_id' not in doc:
+            return False
+
+        old_doc = {}
+        for field in self.query.fields:
+            if field.attname in snapshot:
+                value = field.get_db_prep_save(snapshot[field.attname],
+                                               connection=self.connection)
+                old_doc[field.column] = self.ops.value_for_db(value, field)
+        old_doc.update(get_shadow_values(
+            get_shadow_columns(self.query.get_meta()), old_doc))
+        update_spec = get_update_spec(old_doc, doc)
+        if not update_spec:
+            return True
+        info = collection.update({'_id': doc['_id']}, update_spec, **options)
+        # Save the whole document if it has been deleted meanwhile.
+        return info is None or info.get('n') != 0
+
+    def update_snapshots(self):
+        for obj in self.query.objs:
+            if hasattr(obj, '_mongo_snapshot'):
+                take_snapshot(obj)
+
+    def bulk_insert(self, collection, docs):
+        """
+        Inserts all `docs` with a single batched insert, as used by
+        `QuerySet.bulk_create`, and returns the list of their `_id`s.
+
+        Django splits `bulk_create` calls into batches of at most
+        maxWriteBatchSize documents (see `DatabaseOperations.
+        bulk_batch_size`); the driver further splits each batch if it
+        exceeds the server's message size limit. Pass ``'ordered':
+        False`` in the ``bulk_create`` operation flags to keep inserting
+        after a document fails.
+
+        Generated ObjectIds are also set as primary keys of the model
+        instances that didn't have one yet.
+        """
+        options = self.get_write_options('bulk_create')
+        ordered = options.pop('ordered', True)
+        ids = collection.insert(docs, continue_on_error=not ordered,
+                                **options)
+
+        pk_field = self.query.get_meta().pk
+        for obj, _id in zip(self.query.objs, ids):
+            if getattr(obj, pk_field.attname) is None:
+                value = self.ops.value_from_db(_id, pk_field)
+                value = self.ops.convert_values(value, pk_field)
+                setattr(obj, pk_field.attname, value)
+        return ids
 
 
 # TODO: Define a common nonrel API for updates and add it to the nonrel
@@ -399,7 +1457,14 @@ class SQLUpdateCompiler(NonrelUpdateCompiler, SQLCompiler):
     query_class = MongoQuery
 
     def update(self, values):
-        multi = True
+        multi = not any(field.unique for field, _ in values)
+        return self.execute_update(self.get_update_spec(values), multi)
+
+    def get_update_spec(self, values):
+        """
+        Translates the list of ``(field, value)`` pairs `values` to a
+        MongoDB update document.
+        """
         spec = {}
         for field, value in values:
             if field.primary_key:
@@ -407,26 +1472,43 @@ class SQLUpdateCompiler(NonrelUpdateCompiler, SQLCompiler):
             if getattr(field, 'forbids_updates', False):
                 raise DatabaseError("Updates on %ss are not allowed." %
                                     field.__class__.__name__)
-            if hasattr(value, 'evaluate'):
+            if isinstance(value, UpdateOperator):
+                # .update(foo=Push(42)) --> {'$push': {'foo': 42}}
+                action, value = value.as_update()
+            elif hasattr(value, 'evaluate'):
                 # .update(foo=F('foo') + 42) --> {'$inc': {'foo': 42}}
+                # .update(foo=F('foo') * 2) --> {'$mul': {'foo': 2}}
                 lhs, rhs = value.children
-                assert (value.connector in (value.ADD, value.SUB) and
+                if (value.connector in (value.ADD, value.MUL) and
+                        isinstance(rhs, F)):
+                    # 2 * F('foo') --> F('foo') * 2
+                    lhs, rhs = rhs, lhs
+                assert (value.connector in UPDATE_OPERATORS and
                         not value.negated and
                         isinstance(lhs, F) and not isinstance(rhs, F) and
                         lhs.name == field.name)
                 if value.connector == value.SUB:
                     rhs = -rhs
-                action = '$inc'
+                action = UPDATE_OPERATORS[value.connector]
                 value = rhs
             else:
                 # .update(foo=123) --> {'$set': {'foo': 123}}
                 action = '$set'
             spec.setdefault(action, {})[field.column] = value
 
-            if field.unique:
-                multi = False
-
-        return self.execute_update(spec, multi)
+        # Keep the shadow columns of updated fields up to date.
+        shadow_columns = get_shadow_columns(self.query.get_meta())
+        for field, _, _ in shadow_columns:
+            if any(field.column in updates
+                   for action, updates in spec.iteritems()
+                   if action != '$set'):
+                raise DatabaseError("%s can only be set to values, as its "
+                                    "shadow columns have to be updated too."
+                                    % field.name)
+        if '$set' in spec:
+            spec['$set'].update(get_shadow_values(shadow_columns,
+                                                  spec['$set']))
+        return spec
 
     @safe_call
     def execute_update(self, update_spec, multi=True, **kwargs):
@@ -435,12 +1517,110 @@ class SQLUpdateCompiler(NonrelUpdateCompiler, SQLCompiler):
             criteria = self.build_query().mongo_query
         except EmptyResultSet:
             return 0
-        options = self.connection.operation_flags.get('update', {})
-        options = dict(options, **kwargs)
+        options = dict(self.get_write_options('update'), **kwargs)
         info = collection.update(criteria, update_spec, multi=multi, **options)
         if info is not None:
             return info.get('n')
 
+    @safe_call
+    def find_and_modify(self, update_spec=None, new=False, upsert=False,
+                        remove=False):
+        """
+        Atomically updates (or removes) the first document matched by
+        the query, in the query's order, and returns it as a model
+        instance -- as it was before the update unless `new` is true.
+        Returns ``None`` if no document matches.
+
+        The query's update values are added to `update_spec`.
+        """
+        # Convert the values like NonrelUpdateCompiler.execute_sql.
+        values = []
+        for field, _, value in self.query.values:
+            if hasattr(value, 'prepare_database_save'):
+                value = value.prepare_database_save(field)
+            else:
+                value = field.get_db_prep_save(value,
+                                               connection=self.connection)
+            values.append((field, self.ops.value_for_db(value, field)))
+        update_spec = dict(update_spec or {})
+        for action, updates in self.get_update_spec(values).iteritems():
+            update_spec[action] = dict(update_spec.get(action, {}),
+                                       **updates)
+        return self._find_and_modify(update_spec, new, upsert, remove)[0]
+
+    @safe_call
+    def upsert(self, obj, update_fields=()):
+        """
+        Atomically gets the document matched by the query or, if there
+        is none, inserts the document of the model instance `obj`.
+        `update_fields` are also updated if the document exists.
+
+        Returns an ``(instance, created)`` tuple.
+        """
+        opts = self.query.get_meta()
+        doc = {}
+        for field in opts.fields:
+            if field.primary_key and getattr(obj, field.attname) is None:
+                # Let MongoDB generate an ObjectId.
+                continue
+            # Convert the values like NonrelInsertCompiler.execute_sql.
+            value = field.get_db_prep_save(field.pre_save(obj, True),
+                                           connection=self.connection)
+            if value is None and not field.null and not field.primary_key:
+                raise IntegrityError("You can't set %s (a non-nullable "
+                                     "field) to None!" % field.name)
+            column = '_id' if field.primary_key else field.column
+            doc[column] = self.ops.value_for_db(value, field)
+        shadow_columns = get_shadow_columns(opts)
+        doc.update(get_shadow_values(shadow_columns, doc))
+
+        try:
+            self.build_query()
+        except EmptyResultSet:
+            # No document can match, so insert the new one right away.
+            self.get_collection().insert(doc)
+            return self._make_instance(doc), True
+
+        update_spec = {}
+        update_columns = [field.column for field in update_fields]
+        update_columns.extend(column for field, _, column in shadow_columns
+                              if field in update_fields)
+        for column in update_columns:
+            update_spec.setdefault('$set', {})[column] = doc.pop(column)
+        if doc:
+            update_spec['$setOnInsert'] = doc
+        return self._find_and_modify(update_spec, new=True, upsert=True)
+
+    def _find_and_modify(self, update_spec, new=False, upsert=False,
+                         remove=False):
+        try:
+            query = self.build_query()
+        except EmptyResultSet:
+            return None, False
+        kwargs = {}
+        if remove:
+            kwargs['remove'] = True
+        else:
+            kwargs['update'] = update_spec
+        if query.max_time_ms:
+            kwargs['maxTimeMS'] = query.max_time_ms
+        response = query.collection.find_and_modify(
+            query.mongo_query, sort=query.ordering or None, new=new,
+            upsert=upsert, full_response=True, **kwargs) or {}
+        doc = response.get('value')
+        created = 'upserted' in response.get('lastErrorObject', {})
+        if doc is None:
+            return None, created
+        return self._make_instance(doc), created
+
+    def _make_instance(self, doc):
+        opts = self.query.get_meta()
+        doc[opts.pk.column] = doc.pop('_id')
+        obj = self.query.model(*self._make_result(doc, opts.fields))
+        obj._state.db = self.using
+        obj._state.adding = False
+        return obj
+
 
 class SQLDeleteCompiler(NonrelDeleteCompiler, SQLCompiler):
     pass
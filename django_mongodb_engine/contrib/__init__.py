@@ -1,8 +1,23 @@
 import sys
 
-from django.db import models, connections
+from django.db import models, connections, router
 from django.db.models.query import QuerySet
 from django.db.models.sql.query import Query as SQLQuery
+from django.db.models.sql.subqueries import UpdateQuery
+from django.db.utils import DatabaseError, IntegrityError
+try:
+    from django.db.models.constants import LOOKUP_SEP
+except ImportError:
+    from django.db.models.sql.constants import LOOKUP_SEP
+
+from djangotoolbox.db.basecompiler import EmptyResultSet
+from djangotoolbox.fields import EmbeddedModelField
+
+from ..compiler import OUTPUT_STAGES, get_distinct_stages, safe_call
+from ..creation import get_index_column
+from ..utils import make_index_list, make_read_preference
+from .mapreduce import MapReduceJob
+from .pagination import KeysetPaginator
 
 
 ON_PYPY = hasattr(sys, 'pypy_version_info')
@@ -14,22 +29,11 @@ def _compiler_for_queryset(qs, which='SQLCompiler'):
     return Compiler(qs.query, connection, connection.alias)
 
 
-class RawQuery(SQLQuery):
-
-    def __init__(self, model, raw_query):
-        super(RawQuery, self).__init__(model)
-        self.raw_query = raw_query
-
-    def clone(self, *args, **kwargs):
-        clone = super(RawQuery, self).clone(*args, **kwargs)
-        clone.raw_query = self.raw_query
-        return clone
-
-
 class RawQueryMixin:
 
     def get_raw_query_set(self, raw_query):
-        return QuerySet(self.model, RawQuery(self.model, raw_query), self._db)
+        return MongoDBQuerySet(self.model, RawQuery(self.model, raw_query),
+                               self._db)
 
     def raw_query(self, query=None):
         """
@@ -59,6 +63,50 @@ class RawQueryMixin:
     raw_update.alters_data = True
 
 
+class MongoDBQuery(SQLQuery):
+    """
+    A query that carries MongoDB specific options (such as the cursor
+    batch size) set by :class:`MongoDBQuerySet` methods.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MongoDBQuery, self).__init__(*args, **kwargs)
+        self.mongo_options = {}
+
+    def clone(self, *args, **kwargs):
+        clone = super(MongoDBQuery, self).clone(*args, **kwargs)
+        clone.mongo_options = self.mongo_options.copy()
+        return clone
+
+
+class RawQuery(MongoDBQuery):
+
+    def __init__(self, model, raw_query):
+        super(RawQuery, self).__init__(model)
+        self.raw_query = raw_query
+
+    def clone(self, *args, **kwargs):
+        clone = super(RawQuery, self).clone(*args, **kwargs)
+        clone.raw_query = self.raw_query
+        return clone
+
+
+def _get_embedded_paths(field, names):
+    """
+    Translates the field `names` of the (possibly nested) model embedded
+    by `field` to dotted column paths.
+    """
+    model = field.embedded_model
+    if model is None or isinstance(model, basestring):
+        # Untyped embedding stores the model with the values.
+        return ['.'.join(names), '_module', '_model']
+    subfield = model._meta.get_field(names[0])
+    if len(names) > 1 and isinstance(subfield, EmbeddedModelField):
+        return ['%s.%s' % (subfield.column, path)
+                for path in _get_embedded_paths(subfield, names[1:])]
+    return ['.'.join([subfield.column] + names[1:])]
+
+
 class MapReduceResult(object):
     """
     Represents one item of a MapReduce result array.
@@ -85,6 +133,237 @@ class MapReduceResult(object):
 
 class MongoDBQuerySet(QuerySet):
 
+    def __init__(self, model=None, query=None, using=None):
+        super(MongoDBQuerySet, self).__init__(
+            model, query or MongoDBQuery(model), using)
+
+    def _clone_with_option(self, name, value):
+        clone = self._clone()
+        clone.query.mongo_options[name] = value
+        return clone
+
+    def batch_size(self, size):
+        """
+        Makes the query fetch results from the server in batches of
+        `size` documents, limiting the number of documents that are kept
+        in memory at a time.
+        """
+        return self._clone_with_option('batch_size', size)
+
+    def no_timeout(self):
+        """
+        Keeps the server from closing the query's cursor after it has
+        been idle for 10 minutes, e.g. while processing the results of
+        a long export.
+        """
+        return self._clone_with_option('no_timeout', True)
+
+    def only(self, *fields):
+        """
+        Like :meth:`QuerySet.only <django.db.models.query.QuerySet.only>`,
+        but also accepts paths into :class:`EmbeddedModelFields
+        <djangotoolbox.fields.EmbeddedModelField>` (e.g.
+        ``'author__name'``) to only load parts of embedded models.
+        """
+        names = []
+        embedded = {}
+        for name in fields:
+            parts = name.split('__') if isinstance(name, basestring) else ()
+            field = self._get_field(parts[0]) if len(parts) > 1 else None
+            if isinstance(field, EmbeddedModelField):
+                embedded.setdefault(field.column, []).extend(
+                    _get_embedded_paths(field, parts[1:]))
+                name = parts[0]
+            names.append(name)
+        clone = super(MongoDBQuerySet, self).only(*names)
+        clone.query.mongo_options['embedded_fields'] = embedded
+        return clone
+
+    def slice(self, field_name, count):
+        """
+        Only loads `count` items of the list field `field_name` -- the
+        last ones if `count` is negative -- or, if `count` is a
+        ``[skip, limit]`` list, `limit` items after skipping `skip`.
+
+        .. warning::
+
+           Saving model instances loaded with a sliced list (or with
+           parts of embedded models, see :meth:`only`) overwrites the
+           whole list with the loaded items.
+        """
+        column = self.model._meta.get_field(field_name).column
+        slices = dict(self.query.mongo_options.get('slices', {}))
+        slices[column] = count
+        return self._clone_with_option('slices', slices)
+
+    def _get_field(self, name):
+        opts = self.model._meta
+        if name == 'pk':
+            return opts.pk
+        for field in opts.fields:
+            if field.name == name:
+                return field
+
+    def max_time(self, ms):
+        """
+        Makes the server abort the query (and its ``count()``,
+        ``distinct()`` and aggregations) after `ms` milliseconds,
+        raising :class:`~django_mongodb_engine.utils.MaxTimeExceeded`.
+
+        Overrides the ``MAX_TIME_MS`` database option; ``None`` removes
+        the time limit.
+        """
+        return self._clone_with_option('max_time_ms', ms)
+
+    def read_preference(self, mode, tag_sets=None, max_staleness=None):
+        """
+        Routes the query's reads according to the read preference
+        `mode` (e.g. ``'secondaryPreferred'`` to send an expensive
+        report to the secondaries of a replica set), overriding the
+        model's and the connection's ``read_preference``.
+
+        `max_staleness` is the number of seconds a secondary may lag
+        behind the primary to still be read from. See
+        :func:`~django_mongodb_engine.utils.make_read_preference`.
+        Pass ``None`` to use the connection's read preference.
+        """
+        if mode is not None:
+            mode = make_read_preference(mode, tag_sets, max_staleness)
+        return self._clone_with_option('read_preference', mode)
+
+    def find_and_modify(self, update=None, new=False, sort=None,
+                        upsert=False, remove=False, **values):
+        """
+        Atomically updates the first object matched by the queryset and
+        returns it in one round trip -- as it was before the update,
+        unless `new` is true -- or ``None`` if there's no match::
+
+            job = Job.objects.filter(state='queued').find_and_modify(
+                state='running', tries=F('tries') + 1,
+                sort='-priority', new=True)
+
+        Like for :meth:`update`, `values` are field names and values
+        (including ``F()`` and :class:`~django_mongodb_engine.query.Push`
+        expressions); `update` is an additional raw MongoDB update
+        document. `sort` is a field name or list of field names like for
+        :meth:`order_by`, defaulting to the queryset's ordering. With
+        `upsert`, a document is created if none matches; with `remove`,
+        the object is deleted instead of being updated.
+        """
+        assert self.query.can_filter(), \
+            "Cannot update a query once a slice has been taken."
+        queryset = self._clone()
+        if sort is not None:
+            if isinstance(sort, basestring):
+                sort = [sort]
+            queryset = queryset.order_by(*sort)
+        queryset._for_write = True
+        query = queryset.query.clone(UpdateQuery)
+        query.add_update_values(values)
+        return query.get_compiler(queryset.db).find_and_modify(
+            update, new=new, upsert=upsert, remove=remove)
+    find_and_modify.alters_data = True
+
+    def get_or_create(self, defaults=None, **kwargs):
+        """
+        Like :meth:`QuerySet.get_or_create
+        <django.db.models.query.QuerySet.get_or_create>`, but gets or
+        creates the object atomically with a single upsert, without
+        sending the model's save signals.
+
+        Unlike Django's, it doesn't raise ``MultipleObjectsReturned`` if
+        several objects match: the first one in the queryset's ordering
+        is returned.
+        """
+        return self._upsert(kwargs, defaults or {}, update=False)
+
+    def update_or_create(self, defaults=None, **kwargs):
+        """
+        Like :meth:`get_or_create`, but updates the fields in `defaults`
+        (and ``auto_now`` fields) if the object exists. Only the first
+        matching object is updated.
+        """
+        return self._upsert(kwargs, defaults or {}, update=True)
+    update_or_create.alters_data = True
+
+    def _upsert(self, lookup, defaults, update):
+        # Build the new object like Django's get_or_create does.
+        params = dict((name, value) for name, value in lookup.iteritems()
+                      if LOOKUP_SEP not in name)
+        params.update(defaults)
+        obj = self.model(**params)
+        update_fields = []
+        if update:
+            opts = self.model._meta
+            update_fields = [opts.get_field(name) for name in defaults]
+            update_fields.extend(
+                field for field in opts.fields
+                if getattr(field, 'auto_now', False) and
+                field not in update_fields)
+
+        queryset = self.filter(**lookup)
+        queryset._for_write = True
+        compiler = queryset.query.clone(UpdateQuery).get_compiler(
+            queryset.db)
+        try:
+            return compiler.upsert(obj, update_fields)
+        except IntegrityError:
+            # Concurrent upserts may both insert, one of them failing
+            # on a unique index. Then the document exists now -- unless
+            # the new document violates another unique index, in which
+            # case the retry fails the same way.
+            exc_info = sys.exc_info()
+            try:
+                return compiler.upsert(obj, update_fields)
+            except IntegrityError:
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+    def write_concern(self, **flags):
+        """
+        Makes :meth:`update`, :meth:`delete`, :meth:`create` and
+        :meth:`bulk_create` on the queryset use the write concern
+        `flags`, e.g. ``w=0`` for fire-and-forget writes or
+        ``w='majority'`` for critical ones, overriding the model's
+        ``write_concern`` and the ``OPERATIONS`` flags.
+        """
+        return self._clone_with_option('write_concern', flags)
+
+    def _write_concern(self):
+        return connections[self.db].write_concern(
+            **self.query.mongo_options.get('write_concern') or {})
+
+    def create(self, **kwargs):
+        with self._write_concern():
+            return super(MongoDBQuerySet, self).create(**kwargs)
+
+    def bulk_create(self, *args, **kwargs):
+        with self._write_concern():
+            return super(MongoDBQuerySet, self).bulk_create(*args, **kwargs)
+
+    def delete(self):
+        # Django deletes through new queries, so the write concern can't
+        # be passed with the query like for updates.
+        with self._write_concern():
+            return super(MongoDBQuerySet, self).delete()
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def iterator(self, batch_size=None):
+        """
+        Like :meth:`QuerySet.iterator
+        <django.db.models.query.QuerySet.iterator>`, iterates over the
+        results without caching them. Only one batch of documents is
+        kept in memory at a time, and the cursor is closed as soon as
+        the iterator is exhausted or discarded.
+
+        `batch_size` overrides the batch size set by :meth:`batch_size`.
+        """
+        queryset = self
+        if batch_size is not None:
+            queryset = self.batch_size(batch_size)
+        return super(MongoDBQuerySet, queryset).iterator()
+
+    @safe_call
     def map_reduce(self, *args, **kwargs):
         """
         Performs a Map/Reduce operation on all documents matching the query,
@@ -100,6 +379,8 @@ class MongoDBQuerySet(QuerySet):
         drop_collection = kwargs.pop('drop_collection', False)
         query = self._get_query()
         kwargs.setdefault('query', query.mongo_query)
+        if query.max_time_ms:
+            kwargs.setdefault('maxTimeMS', query.max_time_ms)
         result_collection = query.collection.map_reduce(*args, **kwargs)
         # TODO: Get rid of this.
         # PyPy has no guaranteed garbage collection so we can't rely on
@@ -130,6 +411,7 @@ class MongoDBQuerySet(QuerySet):
         finally:
             result_collection.drop()
 
+    @safe_call
     def inline_map_reduce(self, *args, **kwargs):
         """
         Similar to :meth:`map_reduce` but runs the Map/Reduce in memory,
@@ -140,15 +422,200 @@ class MongoDBQuerySet(QuerySet):
         """
         query = self._get_query()
         kwargs.setdefault('query', query.mongo_query)
+        if query.max_time_ms:
+            kwargs.setdefault('maxTimeMS', query.max_time_ms)
         return [MapReduceResult.from_entity(self.model, entity) for entity in
                 query.collection.inline_map_reduce(*args, **kwargs)]
 
+    def incremental_map_reduce(self, name, map, reduce, out, **kwargs):
+        """
+        Runs the incremental Map/Reduce job `name`, which only processes
+        the documents added since its previous run and reduces their
+        results into the `out` collection. Returns the
+        :class:`~django_mongodb_engine.contrib.mapreduce.MapReduceJob`,
+        whose :attr:`~django_mongodb_engine.contrib.mapreduce.MapReduceJob.state`
+        holds the new watermark.
+
+        Keyword arguments (`field`, `delay`, `finalize`, ...) are passed
+        to :class:`~django_mongodb_engine.contrib.mapreduce.MapReduceJob`.
+        """
+        job = MapReduceJob(name, self, map, reduce, out, **kwargs)
+        job.run()
+        return job
+    incremental_map_reduce.alters_data = True
+
     def _get_query(self):
         return _compiler_for_queryset(self).build_query()
 
     def distinct(self, *args, **kwargs):
         query = self._get_query()
-        return query.get_cursor().distinct(*args, **kwargs)
+        return query.distinct(*args, **kwargs)
+
+    def aggregate_pipeline(self, *stages, **kwargs):
+        """
+        Runs the aggregation pipeline `stages` on the documents matched
+        by this queryset and returns an iterator over the resulting
+        documents, fetched in batches through a cursor.
+
+        The queryset's filters, ordering and slice are prepended to the
+        pipeline as ``$match``, ``$sort``, ``$skip`` and ``$limit``
+        stages. Field names in the `stages` are translated to column
+        names (see :meth:`MongoQuery.translate_pipeline
+        <django_mongodb_engine.compiler.MongoQuery.translate_pipeline>`).
+
+        If the last stage is an ``$out`` or ``$merge`` stage, which may
+        also take a model as its target, the results are written to
+        that collection (replacing or merging into it even if this
+        queryset is empty) and ``None`` is returned. Pass
+        ``allow_disk_use=True`` to let stages that exceed MongoDB's
+        memory limit use temporary files.
+        """
+        allow_disk_use = kwargs.pop('allow_disk_use', False)
+        if kwargs:
+            raise TypeError("Unexpected keyword arguments: %s." %
+                            ', '.join(sorted(kwargs)))
+        try:
+            query = self._get_query()
+        except EmptyResultSet:
+            if not stages or stages[-1].keys()[0] not in OUTPUT_STAGES:
+                return iter([])
+            # The output stage still has to run, on an empty slice of
+            # the unfiltered queryset.
+            queryset = self._clone()
+            queryset.query.where = queryset.query.where_class()
+            queryset.query.having = queryset.query.where_class()
+            queryset.query.set_limits(0, 0)
+            query = queryset._get_query()
+        return query.aggregate_pipeline(stages, allow_disk_use)
+
+    def _group_by(self, key, group, allow_disk_use):
+        # The order of the documents doesn't matter for the $group stage.
+        queryset = self.order_by() if self.query.can_filter() else self
+        if isinstance(key, basestring) and not key.startswith('$'):
+            # Count the items of lists and leave out documents lacking
+            # the field like distinct does.
+            stages = get_distinct_stages(self.model._meta, key)
+            key = '$' + key
+        else:
+            stages = []
+        stages.append({'$group': dict(group, _id=key)})
+        return queryset.aggregate_pipeline(*stages,
+                                           allow_disk_use=allow_disk_use)
+
+    def iter_distinct(self, key, allow_disk_use=True):
+        """
+        Like :meth:`distinct`, but returns an iterator over the distinct
+        values of the field `key`, fetched in batches (see
+        :meth:`batch_size`) through an aggregation cursor. Unlike the
+        result array of :meth:`distinct`, the number of values isn't
+        limited by MongoDB's maximum document size.
+
+        The values are returned in no particular order. Values of
+        list fields are counted item by item, which needs MongoDB 3.2.
+        Pass ``allow_disk_use=False`` to keep the grouping from using
+        temporary files if it exceeds MongoDB's memory limit.
+        """
+        results = self._group_by(key, {}, allow_disk_use)
+        return (result['_id'] for result in results)
+
+    def iter_group(self, key, value, allow_disk_use=True):
+        """
+        Groups the documents by `key` and returns an iterator yielding a
+        :class:`MapReduceResult` for each group, fetched in batches
+        through an aggregation cursor. This is a streaming alternative
+        to :meth:`inline_map_reduce` for Map/Reduces that can be
+        expressed as an aggregation ``$group`` stage.
+
+        `key` is a field name or an aggregation expression. `value` is
+        an accumulator expression (such as ``{'$sum': '$n'}``) or a dict
+        of named accumulator expressions, in which case each result's
+        value is a dict. Field names are translated like in
+        :meth:`aggregate_pipeline`.
+        """
+        if not value:
+            raise ValueError("iter_group() needs an accumulator expression "
+                             "or a dict of them.")
+        if all(name.startswith('$') for name in value):
+            results = self._group_by(key, {'value': value}, allow_disk_use)
+            return (MapReduceResult(self.model, result['_id'],
+                                    result['value'])
+                    for result in results)
+        results = self._group_by(key, value, allow_disk_use)
+        return (MapReduceResult(self.model, result.pop('_id'), result)
+                for result in results)
+
+    def hint(self, index):
+        """
+        Makes MongoDB use the index `index` for this query (including
+        ``count()`` and ``distinct()``), bypassing the query planner.
+
+        `index` is either the name of an index or a list of field names
+        or ``(field name, direction)`` tuples like in
+        :attr:`MongoMeta.indexes`. It must be one of the model's
+        declared indexes; pass ``None`` to remove the hint.
+
+        The ``distinct`` command can't be hinted, so hinted
+        ``distinct()`` calls run as an aggregation instead, which needs
+        MongoDB 3.6.
+        """
+        if index is None:
+            return self._clone_with_option('hint', None)
+        indexes = connections[self.db].creation.get_declared_indexes(
+            self.model)
+        if isinstance(index, basestring) and index in indexes:
+            keys = indexes[index]
+        else:
+            opts = self.model._meta
+            keys = [('_id' if name == 'pk' or name == opts.pk.name
+                     else get_index_column(opts, name), direction)
+                    for name, direction in make_index_list(index)]
+            if keys not in indexes.values():
+                raise DatabaseError("%r is not an index of %s." %
+                                    (index, opts.object_name))
+        return self._clone_with_option('hint', keys)
+
+    def explain(self):
+        """
+        Returns a :class:`~django_mongodb_engine.utils.QueryPlan`
+        describing how MongoDB executes the query: the winning plan, the
+        index used and the number of documents examined and returned.
+        """
+        return self._get_query().explain()
+
+    def keyset_page(self, per_page, token=None):
+        """
+        Returns the page of `per_page` objects that starts at the
+        continuation `token` (or the first page if ``None``), using
+        range queries on the ordering fields instead of skipping over
+        the objects of all previous pages.
+
+        The returned :class:`~django_mongodb_engine.contrib.pagination.KeysetPage`
+        holds the tokens of its neighbours in `next_token` and
+        `previous_token`.
+        """
+        return KeysetPaginator(self, per_page).page(token)
+
+
+class WriteConcernMixin(object):
+    """
+    Lets model instances be saved with a write concern other than the
+    model's::
+
+        class Event(WriteConcernMixin, models.Model):
+            ...
+
+        event.save(write_concern={'w': 0})
+    """
+
+    def save(self, *args, **kwargs):
+        write_concern = kwargs.pop('write_concern', None)
+        if write_concern is None:
+            return super(WriteConcernMixin, self).save(*args, **kwargs)
+        using = kwargs.get('using') or router.db_for_write(
+            self.__class__, instance=self)
+        with connections[using].write_concern(**write_concern):
+            return super(WriteConcernMixin, self).save(*args, **kwargs)
+    save.alters_data = True
 
 
 class MongoDBManager(models.Manager, RawQueryMixin):
@@ -166,9 +633,54 @@ class MongoDBManager(models.Manager, RawQueryMixin):
     def inline_map_reduce(self, *args, **kwargs):
         return self.get_query_set().inline_map_reduce(*args, **kwargs)
 
+    def incremental_map_reduce(self, *args, **kwargs):
+        return self.get_query_set().incremental_map_reduce(*args, **kwargs)
+
+    def keyset_page(self, *args, **kwargs):
+        return self.get_query_set().keyset_page(*args, **kwargs)
+
+    def aggregate_pipeline(self, *stages, **kwargs):
+        return self.get_query_set().aggregate_pipeline(*stages, **kwargs)
+
+    def batch_size(self, size):
+        return self.get_query_set().batch_size(size)
+
+    def no_timeout(self):
+        return self.get_query_set().no_timeout()
+
+    def slice(self, *args, **kwargs):
+        return self.get_query_set().slice(*args, **kwargs)
+
+    def explain(self):
+        return self.get_query_set().explain()
+
+    def hint(self, index):
+        return self.get_query_set().hint(index)
+
+    def max_time(self, ms):
+        return self.get_query_set().max_time(ms)
+
+    def read_preference(self, *args, **kwargs):
+        return self.get_query_set().read_preference(*args, **kwargs)
+
+    def write_concern(self, **flags):
+        return self.get_query_set().write_concern(**flags)
+
+    def find_and_modify(self, *args, **kwargs):
+        return self.get_query_set().find_and_modify(*args, **kwargs)
+
+    def update_or_create(self, *args, **kwargs):
+        return self.get_query_set().update_or_create(*args, **kwargs)
+
     def get_query_set(self):
         return MongoDBQuerySet(self.model, using=self._db)
 
+    def iter_distinct(self, *args, **kwargs):
+        return self.get_query_set().iter_distinct(*args, **kwargs)
+
+    def iter_group(self, *args, **kwargs):
+        return self.get_query_set().iter_group(*args, **kwargs)
+
     def distinct(self, *args, **kwargs):
         """
         Runs a :meth:`~pymongo.Collection.distinct` query against the
@@ -0,0 +1,212 @@
+"""
+Incremental Map/Reduce.
+
+Instead of processing all documents on every run, an incremental job
+only processes the documents added since its previous run and reduces
+their results into the existing output collection (``out={'reduce':
+...}``). Which documents are new is decided by a *watermark* field whose
+values only grow, such as the primary key (ObjectIds grow with their
+creation time) or a creation timestamp. The highest value processed so
+far is stored per job in the :attr:`MapReduceJob.collection_name`
+collection.
+"""
+import datetime
+import json
+
+from bson.code import Code
+from bson.objectid import ObjectId
+from bson.son import SON
+from django.db import connections
+from djangotoolbox.db.basecompiler import EmptyResultSet
+
+from ..compiler import add_condition, safe_call
+
+
+MARKER_KEY = '__mapreduce_job__'
+
+# The wrapped map function emits a marker key (besides the user's
+# keys) that the reduce and finalize functions pass through.
+MAP_WRAPPER = ('function() { (%(function)s).call(this); '
+               'emit(%(marker)s, 1); }')
+REDUCE_WRAPPER = ('function(key, values) { if (key && key.%(key)s !== '
+                  'undefined) return values[0]; '
+                  'return (%(function)s)(key, values); }')
+FINALIZE_WRAPPER = ('function(key, value) { if (key && key.%(key)s !== '
+                    'undefined) return value; '
+                    'return (%(function)s)(key, value); }')
+
+
+def _wrap(template, function, **kwargs):
+    code = template % dict(kwargs, function=function, key=MARKER_KEY)
+    return Code(code, getattr(function, 'scope', None))
+
+
+class MapReduceJob(object):
+    """
+    An incremental Map/Reduce job called `name` over the documents of
+    `queryset`.
+
+    `map`, `reduce` and `finalize` are the JavaScript functions (strings
+    or :class:`~bson.code.Code` objects) and `out` is the name of the
+    output collection (or a model whose collection to use). `field` is
+    the name of the watermark field; it should be indexed. Any other
+    keyword arguments are passed to :meth:`Collection.map_reduce
+    <pymongo.collection.Collection.map_reduce>`.
+
+    Documents that are inserted with a watermark value lower than the
+    one of an already processed document are never processed. With
+    client-generated ObjectIds or timestamps this can happen for
+    documents inserted concurrently with a run; `delay` (a
+    :class:`~datetime.timedelta`) makes runs leave out the documents of
+    the last `delay` for a later run. It's only supported for datetime
+    and ObjectId watermarks.
+
+    Runs are safe to repeat after a crash: the upper watermark of a run
+    is saved before the Map/Reduce is started, and the run also emits a
+    marker document into the output collection, which is written
+    atomically with the results. The next run finishes a crashed run by
+    either repeating it (if the marker is missing) or just saving the
+    new watermark. Runs of the same job must not overlap.
+    """
+    collection_name = 'mapreduce_jobs'
+
+    def __init__(self, name, queryset, map, reduce, out, field='pk',
+                 finalize=None, delay=None, **kwargs):
+        self.name = name
+        self.queryset = queryset
+        self.map = map
+        self.reduce = reduce
+        self.finalize = finalize
+        if not isinstance(out, basestring):
+            out = out._meta.db_table
+        self.out = out
+        self.delay = delay
+        self.kwargs = kwargs
+
+        opts = queryset.model._meta
+        if field == 'pk':
+            field = opts.pk
+        else:
+            field = opts.get_field(field)
+        self.column = '_id' if field.primary_key else field.column
+
+    def _get_query(self):
+        connection = connections[self.queryset.db]
+        compiler = connection.ops.compiler('SQLCompiler')(
+            self.queryset.query, connection, connection.alias)
+        return compiler.build_query()
+
+    def _get_collection(self, name):
+        return connections[self.queryset.db].get_collection(name)
+
+    def _get_marker(self, run):
+        return SON([(MARKER_KEY, self.name), ('run', run)])
+
+    @property
+    def state(self):
+        """
+        The job's state as a dict with the keys ``watermark`` (the
+        highest watermark value processed), ``runs`` (the number of
+        finished runs), ``last_run`` (the UTC time the last run finished)
+        and ``pending`` (the upper watermark of a crashed run that is
+        going to be finished by the next run, or ``None``).
+        """
+        state = self._get_collection(self.collection_name).find_one(
+            {'_id': self.name}) or {}
+        pending = state.get('pending')
+        return {
+            'watermark': state.get('watermark'),
+            'runs': state.get('runs', 0),
+            'last_run': state.get('last_run'),
+            'pending': pending and pending['watermark'],
+        }
+
+    @safe_call
+    def reset(self):
+        """
+        Forgets the job's state, so that the next run processes all
+        documents again. Doesn't touch the output collection.
+        """
+        self._get_collection(self.collection_name).remove({'_id': self.name})
+
+    @safe_call
+    def run(self):
+        """
+        Processes the documents added since the last run and returns
+        the number of processed documents.
+        """
+        jobs = self._get_collection(self.collection_name)
+        output = self._get_collection(self.out)
+        state = jobs.find_one({'_id': self.name}) or {}
+        if state.get('finished_run'):
+            # Clean up after a crash right after finishing the last run.
+            output.remove({'_id': self._get_marker(state['finished_run'])})
+
+        try:
+            query = self._get_query()
+        except EmptyResultSet:
+            return 0
+        low = state.get('watermark')
+        pending = state.get('pending')
+        processed = 0
+        if pending is None:
+            high = self._get_high_watermark(query, low)
+            if high is None:
+                return 0
+            pending = {'watermark': high, 'run': str(ObjectId())}
+            jobs.update({'_id': self.name}, {'$set': {'pending': pending}},
+                        upsert=True)
+            processed = self._map_reduce(query, low, pending)
+        else:
+            # A run crashed; repeat it unless its results were written.
+            marker = self._get_marker(pending['run'])
+            if output.find_one({'_id': marker}) is None:
+                processed = self._map_reduce(query, low, pending)
+
+        jobs.update({'_id': self.name}, {
+            '$set': {'watermark': pending['watermark'],
+                     'last_run': datetime.datetime.utcnow(),
+                     'finished_run': pending['run']},
+            '$unset': {'pending': 1},
+            '$inc': {'runs': 1},
+        })
+        output.remove({'_id': self._get_marker(pending['run'])})
+        return processed
+    run.alters_data = True
+
+    def _get_high_watermark(self, query, low):
+        spec = query.mongo_query.copy()
+        if low is not None:
+            add_condition(spec, self.column, {'$gt': low})
+        if self.delay is not None:
+            cutoff = datetime.datetime.utcnow() - self.delay
+            if self.column == '_id':
+                cutoff = ObjectId.from_datetime(cutoff)
+            add_condition(spec, self.column, {'$lte': cutoff})
+        cursor = query.collection.find(spec, [self.column]) \
+            .sort(self.column, -1).limit(1)
+        for document in cursor:
+            return document.get(self.column)
+        return None
+
+    def _map_reduce(self, query, low, pending):
+        spec = query.mongo_query.copy()
+        bounds = {'$lte': pending['watermark']}
+        if low is not None:
+            bounds['$gt'] = low
+        add_condition(spec, self.column, bounds)
+
+        # Keys are compared in order, so this must match _get_marker.
+        marker = '{%s: %s, "run": %s}' % (json.dumps(MARKER_KEY),
+                                          json.dumps(self.name),
+                                          json.dumps(pending['run']))
+        kwargs = dict(self.kwargs, query=spec, full_response=True)
+        if self.finalize is not None:
+            kwargs['finalize'] = _wrap(FINALIZE_WRAPPER, self.finalize)
+        if query.max_time_ms:
+            kwargs.setdefault('maxTimeMS', query.max_time_ms)
+        response = query.collection.map_reduce(
+            _wrap(MAP_WRAPPER, self.map, marker=marker),
+            _wrap(REDUCE_WRAPPER, self.reduce),
+            SON([('reduce', self.out)]), **kwargs)
+        return response['counts']['input']
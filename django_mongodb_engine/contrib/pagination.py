@@ -0,0 +1,251 @@
+"""
+Keyset (a.k.a. seek) pagination.
+
+Instead of skipping over the documents of all previous pages (which
+gets slower the deeper the page), each page is selected by a range
+predicate on the query's ordering keys, starting at the last document of
+the previous page. Thus every page costs the same as the first one,
+given an index on the ordering keys.
+
+The position of a page is passed around as an opaque continuation
+token. Tokens also carry the index of their page's first object, so
+pages know their position as long as no objects are inserted before or
+deleted from the previous pages meanwhile.
+"""
+import base64
+import json
+
+from django.core.paginator import InvalidPage, Page, Paginator
+from django.db.models import Q
+
+
+KEY_FIELDS = ('AutoField', 'ForeignKey', 'OneToOneField')
+
+
+class InvalidToken(InvalidPage):
+    pass
+
+
+def get_keyset_ordering(queryset):
+    """
+    Returns a list of ``(field, descending)`` tuples for the ordering of
+    `queryset`, with the primary key appended as tie-breaker.
+    """
+    query = queryset.query
+    opts = queryset.model._meta
+    if query.order_by:
+        ordering = query.order_by
+    elif query.default_ordering:
+        ordering = opts.ordering
+    else:
+        ordering = []
+
+    keys = []
+    for name in ordering:
+        if not isinstance(name, basestring) or name == '?':
+            raise ValueError("Can't paginate by %r." % (name,))
+        descending = name.startswith('-')
+        name = name.lstrip('-+')
+        if name == 'pk':
+            field = opts.pk
+        else:
+            try:
+                field = opts.get_field(name)
+            except Exception:
+                raise ValueError("Can't paginate by %r: Only fields of "
+                                 "%s can be used." % (name, opts.object_name))
+        keys.append((field, descending))
+        if field.primary_key:
+            # The primary key is unique, so later keys have no effect.
+            return keys
+
+    keys.append((opts.pk, False))
+    return keys
+
+
+def encode_token(backwards, keys, obj, index):
+    """
+    Returns the continuation token for the page after (or before, if
+    `backwards` is true) `obj`, which is the `index`-th object of the
+    queryset.
+    """
+    values = []
+    for field, _ in keys:
+        value = field.value_from_object(obj)
+        if value is not None:
+            value = field.value_to_string(obj)
+        values.append(value)
+    return base64.urlsafe_b64encode(json.dumps([int(backwards), values,
+                                                index]))
+
+
+def _to_python(field, value):
+    # AutoField keys are strings representing ObjectIds on MongoDB, but
+    # AutoField.to_python would convert them to integers.
+    if value is None or field.get_internal_type() in KEY_FIELDS:
+        return value
+    return field.to_python(value)
+
+
+def decode_token(token, keys):
+    """
+    Returns a ``(backwards, values, index)`` tuple for the continuation
+    token `token`.
+    """
+    try:
+        backwards, values, index = json.loads(
+            base64.urlsafe_b64decode(str(token)))
+        if len(values) != len(keys) or not isinstance(index, (int, long)):
+            raise ValueError
+        values = [_to_python(field, value)
+                  for (field, _), value in zip(keys, values)]
+    except Exception:
+        raise InvalidToken("Invalid continuation token %r." % (token,))
+    return bool(backwards), values, index
+
+
+def keyset_filter(keys, values, backwards=False):
+    """
+    Returns a :class:`~django.db.models.Q` that matches all documents
+    ordered after (or before, if `backwards` is true) the document with
+    the given `values` of the ordering `keys`::
+
+        (a > 1) OR (a = 1 AND b > 2) OR (a = 1 AND b = 2 AND pk > 3)
+    """
+    condition = None
+    equal = {}
+    for (field, descending), value in zip(keys, values):
+        name = 'pk' if field.primary_key else field.name
+        lookup = 'lt' if descending != backwards else 'gt'
+        branch = Q(**dict(equal, **{'%s__%s' % (name, lookup): value}))
+        if condition is None:
+            condition = branch
+        else:
+            condition |= branch
+        equal[name] = value
+    return condition
+
+
+def get_keyset_page(queryset, per_page, token=None):
+    """
+    Returns a ``(object_list, next_token, previous_token, offset)`` tuple
+    for the page of `queryset` specified by `token` (the first page if
+    ``None``). `offset` is the index of the page's first object.
+
+    Tokens are ``None`` if there is no next or previous page.
+    """
+    keys = get_keyset_ordering(queryset)
+    ordering = [('-' if descending else '') +
+                ('pk' if field.primary_key else field.name)
+                for field, descending in keys]
+    backwards, offset = False, 0
+    if token:
+        backwards, values, index = decode_token(token, keys)
+        queryset = queryset.filter(keyset_filter(keys, values, backwards))
+
+    if backwards:
+        ordering = [name[1:] if name.startswith('-') else '-' + name
+                    for name in ordering]
+    object_list = list(queryset.order_by(*ordering)[:per_page + 1])
+    has_more = len(object_list) > per_page
+    del object_list[per_page:]
+
+    if backwards:
+        object_list.reverse()
+        has_next, has_previous = True, has_more
+        # The token's object follows the page.
+        offset = max(index - len(object_list), 0) if has_more else 0
+    else:
+        has_next, has_previous = has_more, bool(token)
+        if token:
+            # The token's object precedes the page.
+            offset = index + 1
+
+    next_token = previous_token = None
+    if object_list:
+        if has_next:
+            next_token = encode_token(False, keys, object_list[-1],
+                                      offset + len(object_list) - 1)
+        if has_previous:
+            previous_token = encode_token(True, keys, object_list[0], offset)
+    return object_list, next_token, previous_token, offset
+
+
+class KeysetPage(Page):
+    """
+    A page of a :class:`KeysetPaginator`.
+
+    Page "numbers" are continuation tokens, so templates written for
+    Django's :class:`~django.core.paginator.Paginator` keep working::
+
+        <a href="?page={{ page.next_page_number }}">next</a>
+
+    :meth:`start_index` and :meth:`end_index` are computed from the
+    `offset` of the page's first object carried along by the tokens.
+    """
+
+    def __init__(self, object_list, token, paginator, next_token,
+                 previous_token, offset=0):
+        super(KeysetPage, self).__init__(object_list, token, paginator)
+        self.next_token = next_token
+        self.previous_token = previous_token
+        self.offset = offset
+
+    def __repr__(self):
+        return '<Page %r>' % (self.number,)
+
+    def has_next(self):
+        return self.next_token is not None
+
+    def has_previous(self):
+        return self.previous_token is not None
+
+    def next_page_number(self):
+        if self.next_token is None:
+            raise InvalidToken("That page contains no results")
+        return self.next_token
+
+    def previous_page_number(self):
+        if self.previous_token is None:
+            raise InvalidToken("That page contains no results")
+        return self.previous_token
+
+    def start_index(self):
+        # Like Paginator, 1-based and 0 for empty pages.
+        if not self.object_list:
+            return 0
+        return self.offset + 1
+
+    def end_index(self):
+        return self.offset + len(self.object_list)
+
+
+class KeysetPaginator(Paginator):
+    """
+    A drop-in replacement for Django's
+    :class:`~django.core.paginator.Paginator` that pages through
+    `object_list` using keyset pagination.
+
+    `object_list` must be a queryset. Its ordering (or its model's
+    default ordering) and the primary key are used as page keys; these
+    fields should be indexed and not be ``None``. :meth:`page` takes a
+    continuation token (or ``None`` for the first page) instead of a
+    page number. :attr:`count` and :attr:`num_pages` are supported but
+    do a count query.
+    """
+
+    def validate_number(self, number):
+        if number in (None, '', 1, '1'):
+            return None
+        if not isinstance(number, basestring):
+            raise InvalidToken("Invalid continuation token %r." % (number,))
+        return number
+
+    def page(self, number=None):
+        token = self.validate_number(number)
+        object_list, next_token, previous_token, offset = get_keyset_page(
+            self.object_list, self.per_page, token)
+        if not object_list and token is not None:
+            raise InvalidToken("That page contains no results")
+        return KeysetPage(object_list, token, self, next_token,
+                          previous_token, offset)
@@ -1,10 +1,34 @@
+import warnings
+
 from django.db.utils import DatabaseError
 
-from pymongo import DESCENDING
+from pymongo import ASCENDING, DESCENDING
 
 from djangotoolbox.db.creation import NonrelDatabaseCreation
 
-from .utils import make_index_list
+from .utils import get_shadow_columns, make_index_list
+
+
+def get_index_column(meta, name):
+    """
+    Translates the field name `name` used in an index declaration to a
+    column name. Names may be dotted paths into embedded models.
+    """
+    from djangotoolbox.fields import AbstractIterableField, \
+        EmbeddedModelField
+
+    opts = meta
+    parts = name.split('.')
+    for i, part in enumerate(parts):
+        field = opts.get_field(part)
+        parts[i] = field.column
+        if isinstance(field, AbstractIterableField):
+            field = field.item_field
+        if isinstance(field, EmbeddedModelField):
+            opts = field.embedded_model._meta
+        else:
+            break
+    return '.'.join(parts)
 
 
 class DatabaseCreation(NonrelDatabaseCreation):
@@ -47,11 +71,33 @@ class DatabaseCreation(NonrelDatabaseCreation):
             self._handle_newstyle_indexes(ensure_index, meta, newstyle_indexes)
         else:
             self._handle_oldstyle_indexes(ensure_index, meta)
+        self._handle_shadow_indexes(ensure_index, meta)
 
-    def _handle_newstyle_indexes(self, ensure_index, meta, indexes):
-        from djangotoolbox.fields import AbstractIterableField, \
-            EmbeddedModelField
+    def get_declared_indexes(self, model):
+        """
+        Returns a dict that maps the names of all indexes declared for
+        `model` (including the one on ``_id``) to their key lists.
+        """
+        meta = model._meta
+        indexes = {'_id_': [('_id', ASCENDING)]}
+
+        def collect(key_or_list, **kwargs):
+            keys = list(make_index_list(key_or_list))
+            name = kwargs.get('name') or \
+                '_'.join('%s_%s' % key for key in keys)
+            indexes[name] = keys
 
+        newstyle_indexes = getattr(meta, 'indexes', None)
+        if newstyle_indexes:
+            self._handle_newstyle_indexes(collect, meta, newstyle_indexes)
+        else:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', DeprecationWarning)
+                self._handle_oldstyle_indexes(collect, meta)
+        self._handle_shadow_indexes(collect, meta)
+        return indexes
+
+    def _handle_newstyle_indexes(self, ensure_index, meta, indexes):
         # Django indexes.
         for field in meta.local_fields:
             if not (field.unique or field.db_index):
@@ -67,30 +113,22 @@ class DatabaseCreation(NonrelDatabaseCreation):
             assert isinstance(fields, (list, tuple))
             indexes.append({'fields': make_index_list(fields), 'unique': True})
 
-        def get_column_name(field):
-            opts = meta
-            parts = field.split('.')
-            for i, part in enumerate(parts):
-                field = opts.get_field(part)
-                parts[i] = field.column
-                if isinstance(field, AbstractIterableField):
-                    field = field.item_field
-                if isinstance(field, EmbeddedModelField):
-                    opts = field.embedded_model._meta
-                else:
-                    break
-            return '.'.join(parts)
-
         for index in indexes:
             if isinstance(index, dict):
                 kwargs = index.copy()
                 fields = kwargs.pop('fields')
             else:
                 fields, kwargs = index, {}
-            fields = [(get_column_name(name), direction)
+            fields = [(get_index_column(meta, name), direction)
                       for name, direction in make_index_list(fields)]
             ensure_index(fields, **kwargs)
 
+    def _handle_shadow_indexes(self, ensure_index, meta):
+        # Shadow columns of the date_parts and case_insensitive_fields
+        # options.
+        for _, _, column in get_shadow_columns(meta):
+            ensure_index(column)
+
     def _handle_oldstyle_indexes(self, ensure_index, meta):
         from warnings import warn
         warn("'descending_indexes', 'sparse_indexes' and 'index_together' "
@@ -162,10 +200,18 @@ class DatabaseCreation(NonrelDatabaseCreation):
                 kwargs['max'] = max_
         else:
             kwargs = {}
+        collation = getattr(model._meta, 'collation', None)
+        if collation is not None:
+            kwargs['collation'] = getattr(collation, 'document', collation)
 
         collection = self.connection.get_collection(name, existing=True)
         if collection is not None:
             opts = dict(collection.options())
+            if 'collation' in opts and 'collation' in kwargs:
+                # MongoDB adds the defaults of all collation options.
+                opts['collation'] = dict(
+                    (key, opts['collation'].get(key))
+                    for key in kwargs['collation'])
             if opts != kwargs:
                 raise DatabaseError("Can't change options of an existing "
                                     "collection: %s --> %s." % (opts, kwargs))
@@ -218,3 +264,4 @@ class DatabaseCreation(NonrelDatabaseCreation):
         for collection in self.connection.introspection.table_names():
             if not collection.startswith('system.'):
                 self.connection.database.drop_collection(collection)
+        self.connection.invalidate_collection_names()
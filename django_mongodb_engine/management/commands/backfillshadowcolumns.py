@@ -0,0 +1,45 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections, router
+from django.db.models import get_app, get_models
+
+from django_mongodb_engine.utils import backfill_shadow_columns, \
+    get_shadow_columns
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help="Nominates a database to backfill. Defaults to "
+                         "the \"default\" database."),
+    )
+    help = ("Stores the missing shadow columns of the date_parts and "
+            "case_insensitive_fields options of the models of the given "
+            "apps (or of all apps).")
+    args = '[appname ...]'
+
+    def handle(self, *app_labels, **options):
+        verbosity = int(options.get('verbosity', 1))
+        using = options.get('database', DEFAULT_DB_ALIAS)
+        connection = connections[using]
+        if app_labels:
+            models = []
+            for app_label in app_labels:
+                models.extend(get_models(get_app(app_label)))
+        else:
+            models = get_models()
+
+        for model in models:
+            opts = model._meta
+            if not opts.managed or opts.proxy or \
+                    not router.allow_syncdb(using, model) or \
+                    not get_shadow_columns(opts):
+                continue
+            updated = backfill_shadow_columns(
+                connection.get_collection(opts.db_table), opts)
+            if verbosity >= 1:
+                self.stdout.write("Backfilled %d documents of %s.%s." %
+                                  (updated, opts.app_label,
+                                   opts.object_name))
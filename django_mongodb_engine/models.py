@@ -1,8 +1,28 @@
 # If you wonder what this file is about please head over to '__init__.py' :-)
 
+import copy
+
 from django.db.models import signals
 
 
+def take_snapshot(instance):
+    """
+    Remembers the current values of `instance`'s loaded fields, so that
+    saving it only sends the fields changed since (see the
+    ``track_changes`` model option).
+    """
+    values = instance.__dict__
+    instance._mongo_snapshot = dict(
+        (field.attname, copy.deepcopy(values[field.attname]))
+        for field in instance._meta.fields
+        # Deferred fields aren't in __dict__ until they're loaded.
+        if not field.primary_key and field.attname in values)
+
+
+def post_init_snapshot_signal(sender, instance, **kwargs):
+    take_snapshot(instance)
+
+
 def class_prepared_mongodb_signal(sender, *args, **kwargs):
     mongo_meta = getattr(sender, 'MongoMeta', None)
     if mongo_meta is not None:
@@ -13,5 +33,7 @@ def class_prepared_mongodb_signal(sender, *args, **kwargs):
                 else:
                     attr_name = attr
                 setattr(sender._meta, attr_name, getattr(mongo_meta, attr))
+        if getattr(mongo_meta, 'track_changes', False):
+            signals.post_init.connect(post_init_snapshot_signal, sender=sender)
 
 signals.class_prepared.connect(class_prepared_mongodb_signal)
@@ -0,0 +1,135 @@
+"""
+Process-wide registry of PyMongo clients.
+
+Django creates one :class:`~django_mongodb_engine.base.DatabaseWrapper`
+per thread and database alias. Every PyMongo client has its own socket
+pool and monitor threads, so wrappers with the same connection settings
+share a single client instead of creating one each.
+"""
+import os
+import threading
+import time
+
+try:
+    from pymongo.monitoring import ConnectionPoolListener
+except ImportError:
+    # PyMongo < 3.9 doesn't publish connection pool events.
+    ConnectionPoolListener = None
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+_clients_pid = os.getpid()
+
+
+class PoolStats(object):
+    """
+    Usage statistics of a shared client.
+
+    ``connects`` counts how often database wrappers connected using the
+    client (including reconnects after a fork); wrappers that are closed
+    or garbage collected aren't subtracted. The socket statistics
+    (``connections_created``, ``checked_out``, ``checkouts`` and
+    ``checkout_wait_time`` in seconds) are only collected with PyMongo
+    >= 3.9.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.connections_created = 0
+        self.checked_out = 0
+        self.checkouts = 0
+        self.checkout_wait_time = 0.0
+
+    def incr(self, attr, value=1):
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + value)
+
+    def as_dict(self):
+        return dict((key, value) for key, value in self.__dict__.iteritems()
+                    if not key.startswith('_'))
+
+
+if ConnectionPoolListener is not None:
+
+    class PoolStatsListener(ConnectionPoolListener):
+
+        def __init__(self, stats):
+            self.stats = stats
+            self._checkout_started = threading.local()
+
+        def connection_created(self, event):
+            self.stats.incr('connections_created')
+
+        def connection_check_out_started(self, event):
+            self._checkout_started.time = time.time()
+
+        def connection_checked_out(self, event):
+            started = getattr(self._checkout_started, 'time', None)
+            if started is not None:
+                self.stats.incr('checkout_wait_time', time.time() - started)
+            self.stats.incr('checkouts')
+            self.stats.incr('checked_out')
+
+        def connection_checked_in(self, event):
+            self.stats.incr('checked_out', -1)
+
+        def pool_created(self, event):
+            pass
+
+        def pool_cleared(self, event):
+            pass
+
+        def pool_closed(self, event):
+            pass
+
+        def connection_ready(self, event):
+            pass
+
+        def connection_closed(self, event):
+            pass
+
+        def connection_check_out_failed(self, event):
+            pass
+
+
+def get_client(connection_class, conn_options, credentials=()):
+    """
+    Returns a ``(client, stats)`` tuple for the given connection class
+    and options, creating the client on first use.
+
+    Clients aren't shared with processes forked off after they were
+    created: in a child process, new clients are created.
+    """
+    global _clients_pid
+    key = (connection_class, repr(sorted(conn_options.items())),
+           tuple(credentials))
+
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            # PyMongo clients must not be used across fork().
+            _clients.clear()
+            _clients_pid = os.getpid()
+
+        entry = _clients.get(key)
+        if entry is None:
+            stats = PoolStats()
+            if ConnectionPoolListener is not None:
+                conn_options = dict(conn_options, event_listeners=list(
+                    conn_options.get('event_listeners', [])) +
+                    [PoolStatsListener(stats)])
+            entry = _clients[key] = connection_class(**conn_options), stats
+
+    entry[1].incr('connects')
+    return entry
+
+
+def get_stats():
+    """
+    Returns a list of ``(client, stats dict)`` tuples for all clients
+    created in this process.
+    """
+    with _clients_lock:
+        entries = _clients.values()
+    return [(client, stats.as_dict()) for client, stats in entries]
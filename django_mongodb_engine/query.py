@@ -1,10 +1,14 @@
+import copy
 from warnings import warn
 
+from bson.son import SON
+
 from djangotoolbox.fields import RawField, AbstractIterableField, \
     EmbeddedModelField
 
 
-__all__ = ['A']
+__all__ = ['A', 'Push', 'AddToSet', 'Pull', 'Pop', 'MinUpdate', 'MaxUpdate',
+           'CurrentDate']
 
 
 DJANGOTOOLBOX_FIELDS = (RawField, AbstractIterableField, EmbeddedModelField)
@@ -24,3 +28,156 @@ class A(object):
         else:
             raise TypeError("Can not use A() queries on %s." %
                             field.__class__.__name__)
+
+
+class UpdateOperator(object):
+    """
+    Base class for update expressions that compile to a MongoDB update
+    operator, such as :class:`Push` or :class:`MaxUpdate`.
+    """
+    operator = None
+
+    def prepare_database_save(self, field):
+        # Keeps Django from converting the expression like a field value.
+        return self
+
+    def convert(self, func):
+        """
+        Returns a copy of the expression with its values converted by
+        `func`.
+        """
+        return self
+
+    def as_update(self):
+        """
+        Returns the update operator and the value for the field.
+        """
+        raise NotImplementedError
+
+
+class ArrayUpdate(UpdateOperator):
+    """
+    Base class for update expressions that atomically modify the items
+    of a ``ListField`` or ``SetField``::
+
+        Post.objects.filter(...).update(tags=Push('django'))
+
+    Values are converted like the field's items; more values can be
+    passed as positional arguments or as the `each` list.
+    """
+    operator = None
+    modifiers = ()
+
+    def __init__(self, *values, **options):
+        values = list(values)
+        values.extend(options.pop('each', ()))
+        for name in options:
+            if name not in self.modifiers:
+                raise TypeError("%s() got an unexpected keyword argument "
+                                "%r." % (self.__class__.__name__, name))
+        self.values = values
+        self.options = options
+
+    def convert(self, func):
+        clone = copy.copy(self)
+        clone.values = list(func(self.values))
+        return clone
+
+    def as_update(self):
+        if len(self.values) == 1 and not self.options:
+            return self.operator, self.values[0]
+        value = SON([('$each', self.values)])
+        for name in self.modifiers:
+            if name in self.options:
+                value['$' + name] = self.options[name]
+        return self.operator, value
+
+
+class Push(ArrayUpdate):
+    """
+    Appends values to a list (``$push``). `slice` keeps only the first
+    (or, if negative, the last) items of the list afterwards, `sort`
+    sorts it and `position` inserts the values at the given index
+    instead.
+    """
+    operator = '$push'
+    modifiers = ('sort', 'slice', 'position')
+
+
+class AddToSet(ArrayUpdate):
+    """
+    Appends values that aren't in the list yet (``$addToSet``).
+    """
+    operator = '$addToSet'
+
+
+class Pull(ArrayUpdate):
+    """
+    Removes all occurrences of the values from the list (``$pull`` or
+    ``$pullAll``).
+    """
+    operator = '$pull'
+
+    def as_update(self):
+        if len(self.values) == 1:
+            return self.operator, self.values[0]
+        return '$pullAll', self.values
+
+
+class Pop(ArrayUpdate):
+    """
+    Removes the last item of the list (``$pop``), or the first one if
+    `first` is true.
+    """
+    operator = '$pop'
+
+    def __init__(self, first=False):
+        super(Pop, self).__init__()
+        self.first = first
+
+    def as_update(self):
+        return self.operator, -1 if self.first else 1
+
+
+class MinUpdate(UpdateOperator):
+    """
+    Sets the field to `value` if that's less than the field's current
+    value (``$min``). Not to be confused with the ``Min`` aggregate.
+    """
+    operator = '$min'
+
+    def __init__(self, value):
+        self.value = value
+
+    def convert(self, func):
+        clone = copy.copy(self)
+        clone.value = func(self.value)
+        return clone
+
+    def as_update(self):
+        return self.operator, self.value
+
+
+class MaxUpdate(MinUpdate):
+    """
+    Sets the field to `value` if that's greater than the field's
+    current value (``$max``). Not to be confused with the ``Max``
+    aggregate.
+    """
+    operator = '$max'
+
+
+class CurrentDate(UpdateOperator):
+    """
+    Sets the field to the server's current date and time (in UTC) --
+    as a timestamp if `timestamp` is true (``$currentDate``).
+    """
+    operator = '$currentDate'
+
+    def __init__(self, timestamp=False):
+        self.timestamp = timestamp
+
+    def as_update(self):
+        if self.timestamp:
+            return self.operator, {'$type': 'timestamp'}
+        return self.operator, True
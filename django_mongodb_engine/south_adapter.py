@@ -82,14 +82,17 @@ class DatabaseOperations(DatabaseOperations):
         # fail if the collection doesn't already exist.
         connection = self._get_connection()
         connection.database.create_collection(table_name, **kwargs)
+        connection.invalidate_collection_names()
     
     def rename_table(self, table_name, new_table_name):
         collection = self._get_collection(table_name)
         collection.rename(new_table_name)
+        self._get_connection().invalidate_collection_names()
 
     def delete_table(self, table_name, cascade=True):
         connection = self._get_connection()
         connection.database.drop_collection(table_name)
+        connection.invalidate_collection_names()
 
     def start_transaction(self):
         # MongoDB doesn't support transactions
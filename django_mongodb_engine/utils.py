@@ -1,10 +1,14 @@
+from itertools import count
 import re
+import threading
 import time
 
 from django.conf import settings
 from django.db.backends.util import logger
+from django.db.utils import DatabaseError
+from django.utils import timezone
 
-from pymongo import ASCENDING
+from pymongo import ASCENDING, ReadPreference
 from pymongo.cursor import Cursor
 
 
@@ -23,6 +27,129 @@ def safe_regex(regex, *re_args, **re_kwargs):
     return wrapper
 
 
+class QueryPlanError(DatabaseError):
+    """
+    Raised for queries that scan the whole collection or sort in memory
+    if query plan checks are enabled (see ``CHECK_QUERY_PLANS``).
+    """
+
+
+class MaxTimeExceeded(DatabaseError):
+    """
+    Raised if a query exceeds its time budget (see ``MAX_TIME_MS`` and
+    :meth:`~django_mongodb_engine.contrib.MongoDBQuerySet.max_time`).
+    """
+
+
+class QueryPlan(object):
+    """
+    Summary of the output of :meth:`Cursor.explain
+    <pymongo.cursor.Cursor.explain>`, for both the MongoDB 3.0+ and the
+    legacy explain format.
+
+    :param explanation: the explain output, available as :attr:`raw`
+    """
+
+    def __init__(self, explanation):
+        self.raw = explanation
+        if 'queryPlanner' in explanation:
+            self.winning_plan = explanation['queryPlanner']['winningPlan']
+            self.stages = list(self._iter_stages(self.winning_plan))
+            self.index = first(bool, (stage.get('indexName')
+                                      for stage in self.stages))
+            self.collection_scan = any(stage['stage'] == 'COLLSCAN'
+                                       for stage in self.stages)
+            self.in_memory_sort = any(stage['stage'] == 'SORT'
+                                      for stage in self.stages)
+            stats = explanation.get('executionStats', {})
+            self.docs_examined = stats.get('totalDocsExamined')
+            self.keys_examined = stats.get('totalKeysExamined')
+            self.returned = stats.get('nReturned')
+        else:
+            # MongoDB < 3.0
+            self.winning_plan = explanation
+            self.stages = []
+            cursor = explanation.get('cursor', '')
+            self.index = cursor.split(' ', 1)[1] \
+                if cursor.startswith('BtreeCursor ') else None
+            self.collection_scan = cursor.startswith('BasicCursor')
+            self.in_memory_sort = bool(explanation.get('scanAndOrder'))
+            self.docs_examined = explanation.get('nscannedObjects')
+            self.keys_examined = explanation.get('nscanned')
+            self.returned = explanation.get('n')
+
+    def _iter_stages(self, stage):
+        yield stage
+        children = list(stage.get('inputStages', []))
+        if 'inputStage' in stage:
+            children = [stage['inputStage']]
+        # Sharded queries have one plan per shard.
+        children += [shard['winningPlan'] for shard in stage.get('shards', [])
+                     if 'winningPlan' in shard]
+        for child in children:
+            for substage in self._iter_stages(child):
+                yield substage
+
+    def __repr__(self):
+        return '<QueryPlan index=%r collection_scan=%r in_memory_sort=%r ' \
+               'docs_examined=%r returned=%r>' % (
+                   self.index, self.collection_scan, self.in_memory_sort,
+                   self.docs_examined, self.returned)
+
+
+class LRUCache(object):
+    """
+    A mapping of at most `max_size` items (none if `max_size` is 0)
+    that evicts the least recently used items first and counts cache
+    hits and misses. It's safe to use from several threads.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = {}
+        self._clock = count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items[key][0]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value, next(self._clock)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if not self.max_size:
+            return
+        with self._lock:
+            self._items[key] = value, next(self._clock)
+            if len(self._items) > self.max_size:
+                # Evict the least recently used tenth at once so that
+                # eviction doesn't have to sort on every insertion.
+                by_age = sorted(self._items.iteritems(),
+                                key=lambda item: item[1][1])
+                for key, _ in by_age[:max(1, self.max_size // 10)]:
+                    del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._items), 'max_size': self.max_size}
+
+
 def make_struct(*attrs):
 
     class _Struct(object):
@@ -35,6 +162,181 @@ def make_struct(*attrs):
     return _Struct
 
 
+def aggregate_cursor(collection, pipeline, batch_size=None, **kwargs):
+    """
+    Runs the aggregation `pipeline` on `collection` and returns a
+    :class:`~pymongo.command_cursor.CommandCursor` over the results
+    (PyMongo 2.x only returns a cursor if asked for one).
+    """
+    cursor = {}
+    if batch_size:
+        cursor['batchSize'] = batch_size
+    return collection.aggregate(pipeline, cursor=cursor, **kwargs)
+
+
+READ_PREFERENCE_MODES = {
+    'primary': 'PRIMARY',
+    'primarypreferred': 'PRIMARY_PREFERRED',
+    'secondary': 'SECONDARY',
+    'secondarypreferred': 'SECONDARY_PREFERRED',
+    'nearest': 'NEAREST',
+}
+
+
+def make_read_preference(mode, tag_sets=None, max_staleness=None):
+    """
+    Returns the PyMongo read preference for `mode`, which is a read
+    preference mode name (e.g. ``'secondaryPreferred'``), a PyMongo
+    read preference or a dict of arguments to this function.
+
+    `tag_sets` and `max_staleness` (in seconds; servers lagging further
+    behind the primary aren't read from) require PyMongo 3 and 3.4.
+    """
+    if isinstance(mode, dict):
+        return make_read_preference(**mode)
+    if isinstance(mode, basestring):
+        try:
+            name = READ_PREFERENCE_MODES[mode.replace('_', '').lower()]
+        except KeyError:
+            raise ValueError("Unknown read preference %r." % mode)
+        mode = getattr(ReadPreference, name)
+    if tag_sets is None and max_staleness is None:
+        return mode
+
+    kwargs = {}
+    if tag_sets is not None:
+        kwargs['tag_sets'] = tag_sets
+    if max_staleness is not None:
+        kwargs['max_staleness'] = max_staleness
+    try:
+        # PyMongo 3 read preferences are immutable objects.
+        return type(mode)(**kwargs)
+    except TypeError:
+        raise ValueError("Read preference %r doesn't support %s with this "
+                         "version of PyMongo." %
+                         (mode, ' and '.join(sorted(kwargs))))
+
+
+def get_update_spec(old, new):
+    """
+    Returns an update document with the ``$set`` and ``$unset``
+    operations that turn the document `old` into `new`, using dotted
+    paths for changes inside embedded documents.
+    """
+    spec = {}
+
+    def diff(old, new, prefix):
+        for key, value in new.iteritems():
+            if key == '_id' and not prefix:
+                continue
+            if (key in old and isinstance(old[key], dict) and
+                    isinstance(value, dict)):
+                diff(old[key], value, prefix + key + '.')
+            elif key not in old or old[key] != value:
+                spec.setdefault('$set', {})[prefix + key] = value
+        for key in old:
+            if key not in new:
+                spec.setdefault('$unset', {})[prefix + key] = 1
+
+    diff(old, new, '')
+    return spec
+
+
+# Lookups on parts of dates, see the ``date_parts`` model option.
+DATE_PARTS = ('month', 'day', 'week_day', 'hour', 'minute', 'second')
+
+
+def get_shadow_columns(opts):
+    """
+    Returns a list of ``(field, name, column)`` tuples for the shadow
+    columns of the model with the options `opts`: one for each part
+    listed in its ``date_parts`` option (`name` being the part) and
+    one for each of its ``case_insensitive_fields`` (`name` being
+    ``'lower'``).
+    """
+    columns = []
+    for name, parts in getattr(opts, 'date_parts', {}).iteritems():
+        field = opts.get_field(name)
+        for part in parts:
+            if part not in DATE_PARTS:
+                raise ValueError("Unknown date part %r in the date_parts "
+                                 "of %s." % (part, opts.object_name))
+            columns.append((field, part, '%s__%s' % (field.column, part)))
+    for name in getattr(opts, 'case_insensitive_fields', ()):
+        field = opts.get_field(name)
+        columns.append((field, 'lower', '%s__lower' % field.column))
+    return columns
+
+
+def get_shadow_values(columns, doc):
+    """
+    Returns a dict mapping the shadow `columns` (see
+    :func:`get_shadow_columns`) of the fields in the document `doc` to
+    their values.
+    """
+    values = {}
+    for field, name, column in columns:
+        if field.column not in doc:
+            continue
+        value = doc[field.column]
+        if value is None:
+            pass
+        elif name == 'lower':
+            value = value.lower()
+        else:
+            value = get_date_part(field, value, name)
+        values[column] = value
+    return values
+
+
+def backfill_shadow_columns(collection, opts):
+    """
+    Stores the missing shadow columns (see :func:`get_shadow_columns`)
+    of the documents in `collection`, which holds the model with the
+    options `opts`, and returns the number of updated documents.
+
+    Documents saved before a field was added to the model's
+    ``date_parts`` or ``case_insensitive_fields`` lack its shadow
+    columns, so lookups using them wouldn't find these documents.
+    """
+    columns = get_shadow_columns(opts)
+    if not columns:
+        return 0
+    spec = {'$or': [{field.column: {'$exists': True},
+                     column: {'$exists': False}}
+                    for field, _, column in columns]}
+    source_columns = list(set(field.column for field, _, _ in columns))
+    updated = 0
+    for doc in collection.find(spec, source_columns):
+        # Don't overwrite the shadow values of documents whose fields
+        # were changed in the meantime.
+        selector = {'_id': doc['_id']}
+        for column in source_columns:
+            selector[column] = doc.get(column, {'$exists': False})
+        collection.update(selector,
+                          {'$set': get_shadow_values(columns, doc)})
+        updated += 1
+    return updated
+
+
+def get_date_part(field, value, part):
+    """
+    Returns the date part `part` of the `field`'s database value
+    `value`, as used by Django's lookups.
+    """
+    if settings.USE_TZ and field.get_internal_type() == 'DateTimeField':
+        # Like Django, use local time. The current time zone isn't
+        # known at save time, so use the default one; lookups only use
+        # the shadow columns while it's the current one.
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value, timezone.utc)
+        value = timezone.localtime(value, timezone.get_default_timezone())
+    if part == 'week_day':
+        # 1 (Sunday) to 7 (Saturday), like $dayOfWeek.
+        return value.isoweekday() % 7 + 1
+    return getattr(value, part)
+
+
 def make_index_list(indexes):
     if isinstance(indexes, basestring):
         indexes = [indexes]
@@ -83,8 +385,10 @@ class CollectionDebugWrapper(object):
         return wrapper
 
     save = logging_wrapper('save')
+    insert = logging_wrapper('insert')
     remove = logging_wrapper('remove')
     update = logging_wrapper('update')
+    aggregate = logging_wrapper('aggregate')
     map_reduce = logging_wrapper('map_reduce')
     inline_map_reduce = logging_wrapper('inline_map_reduce')
 
@@ -2,5 +2,6 @@ from django.db import models
 
 
 class Person(models.Model):
-    age = models.IntegerField()
+    age = models.IntegerField(null=True)
     birthday = models.DateTimeField()
+    height = models.DecimalField(max_digits=5, decimal_places=2, null=True)
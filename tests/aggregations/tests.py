@@ -1,4 +1,5 @@
-from datetime import datetime
+from datetime import date, datetime
+from decimal import Decimal
 
 from django.db.models.aggregates import Count, Sum, Max, Min, Avg
 
@@ -33,3 +34,72 @@ class SimpleTest(TestCase):
             'age__avg': 6.0,
             'id__count': 4,
         })
+
+    def test_count_and_sum(self):
+        for age in [1, 2, 2, None]:
+            Person.objects.create(age=age, birthday=datetime(2000, 1, 1))
+
+        self.assertEqual(
+            Person.objects.aggregate(Count('id'), Count('age'), Sum('age'),
+                                     distinct=Count('age', distinct=True)),
+            {'id__count': 4, 'age__count': 3, 'age__sum': 5, 'distinct': 2})
+
+    def test_empty(self):
+        self.assertEqual(
+            Person.objects.filter(age=42).aggregate(Min('age'), Sum('age'),
+                                                    Count('age')),
+            {'age__min': None, 'age__sum': None, 'age__count': 0})
+
+
+class GroupByTests(TestCase):
+
+    def setUp(self):
+        for age in [1, 2, 2, 3, 3, 3]:
+            Person.objects.create(age=age, birthday=datetime(2000, 1, age))
+
+    def test_values_annotate(self):
+        self.assertEqual(
+            list(Person.objects.values('age').annotate(n=Count('id'))
+                                             .order_by('age')),
+            [{'age': 1, 'n': 1}, {'age': 2, 'n': 2}, {'age': 3, 'n': 3}])
+        self.assertEqual(
+            list(Person.objects.filter(age__gt=1).values_list('age')
+                               .annotate(Sum('age'), Max('birthday'))
+                               .order_by('-age')),
+            [(3, 9, datetime(2000, 1, 3)), (2, 4, datetime(2000, 1, 2))])
+
+    def test_having(self):
+        self.assertEqual(
+            list(Person.objects.values_list('age').annotate(n=Count('id'))
+                               .filter(n__gte=2).order_by('age')),
+            [(2, 2), (3, 3)])
+        self.assertEqual(
+            list(Person.objects.values_list('age').annotate(n=Count('id'))
+                               .exclude(n=2).order_by('age')),
+            [(1, 1), (3, 3)])
+
+    def test_having_converts_values(self):
+        for person, height in zip(Person.objects.order_by('pk'),
+                                  ['9.5', '10.25', '80', '100', '1', '2']):
+            person.height = Decimal(height)
+            person.save()
+        qs = Person.objects.values_list('age').order_by('age')
+        self.assertEqual(
+            [row[0] for row in qs.annotate(last=Max('birthday'))
+                                 .filter(last__gt=date(2000, 1, 2))],
+            [3])
+        self.assertEqual(
+            [row[0] for row in qs.annotate(tallest=Max('height'))
+                                 .filter(tallest__gt=Decimal('10'))],
+            [2, 3])
+        self.assertEqual(
+            [row[0] for row in qs.annotate(average=Avg('age'))
+                                 .filter(average__lt=Decimal('2.5'))],
+            [1, 2])
+
+    def test_order_by_annotation_and_slice(self):
+        qs = Person.objects.values_list('age', flat=True) \
+                           .annotate(n=Count('id')).order_by('-n')
+        self.assertEqual(list(qs), [3, 2, 1])
+        self.assertEqual(list(qs[1:]), [2, 1])
+        self.assertEqual(list(qs[:1]), [3])
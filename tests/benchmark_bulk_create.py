@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Compares the insert throughput of ``bulk_create`` against one ``save()``
+per document.
+
+Usage (from the tests directory, with a MongoDB server running)::
+
+    ./benchmark_bulk_create.py [number of documents]
+
+The documents are inserted into the test database (``TEST_NAME`` or
+``test_<NAME>``), which is created for the benchmark and dropped
+afterwards.
+"""
+import os
+import sys
+import time
+
+
+def timed(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def main(count):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+    from django.db import connection
+
+    # Like the test runner, work on a test database that is dropped
+    # afterwards, so that no existing data is touched.
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        run(count)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def run(count):
+    from query.models import Blog
+
+    def save_each():
+        for i in xrange(count):
+            Blog(title='blog %d' % i).save()
+
+    def bulk_create():
+        Blog.objects.bulk_create([Blog(title='blog %d' % i)
+                                  for i in xrange(count)])
+
+    for name, func in [('save()', save_each), ('bulk_create()', bulk_create)]:
+        Blog.objects.all().delete()
+        duration = timed(func)
+        assert Blog.objects.count() == count
+        print '%-15s %8d rows in %6.2fs  (%.0f rows/s)' % (
+            name, count, duration, count / duration)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -2,7 +2,9 @@ from django.conf import settings
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 
-from django_mongodb_engine.contrib import MongoDBManager
+from djangotoolbox.fields import EmbeddedModelField, ListField
+
+from django_mongodb_engine.contrib import MongoDBManager, WriteConcernMixin
 from django_mongodb_engine.contrib.search.fields import TokenizedField
 
 
@@ -19,8 +21,67 @@ class MapReduceModelWithCustomPrimaryKey(models.Model):
     objects = MongoDBManager()
 
 
+class PipelineModel(models.Model):
+    category = models.CharField(max_length=20, db_column='cat')
+    n = models.IntegerField()
+
+    objects = MongoDBManager()
+
+
 class Post(models.Model):
     content = TokenizedField(max_length=255)
 
     def __unicode__(self):
         return "Post"
+
+
+class Author(models.Model):
+    name = models.CharField(max_length=100)
+    email = models.CharField(max_length=100, db_column='mail')
+
+
+class ProjectionModel(models.Model):
+    title = models.CharField(max_length=100)
+    body = models.TextField()
+    author = EmbeddedModelField(Author, null=True)
+    tags = ListField(models.CharField(max_length=20))
+
+    objects = MongoDBManager()
+
+
+class UniqueModel(models.Model):
+    name = models.CharField(max_length=20, unique=True)
+    code = models.CharField(max_length=20, unique=True)
+
+    objects = MongoDBManager()
+
+
+class IndexedModel(models.Model):
+    a = models.IntegerField(db_index=True)
+    b = models.IntegerField()
+    c = models.IntegerField(null=True, db_column='cc')
+    tags = ListField(null=True)
+
+    objects = MongoDBManager()
+
+    class MongoMeta:
+        indexes = [[('a', 1), ('b', -1)],
+                   {'fields': ['b'], 'name': 'b_index'}]
+
+
+class SecondaryReadModel(models.Model):
+    n = models.IntegerField()
+
+    objects = MongoDBManager()
+
+    class MongoMeta:
+        read_preference = 'secondaryPreferred'
+
+
+class WriteConcernModel(WriteConcernMixin, models.Model):
+    n = models.IntegerField()
+
+    objects = MongoDBManager()
+
+    class MongoMeta:
+        write_concern = {'w': 0}
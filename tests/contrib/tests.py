@@ -2,10 +2,19 @@ from __future__ import with_statement
 
 from functools import partial
 
-from django.db.models import Q
-from django.db.utils import DatabaseError
+from django.core.paginator import InvalidPage
+from django.db import connections
+from django.db.models import F, Q
+from django.db.utils import DatabaseError, IntegrityError
 
-from django_mongodb_engine.contrib import MapReduceResult
+from bson.objectid import ObjectId
+from pymongo import ReadPreference
+
+from django_mongodb_engine.contrib import MapReduceResult, \
+    MongoDBQuerySet, _compiler_for_queryset
+from django_mongodb_engine.contrib.mapreduce import MapReduceJob
+from django_mongodb_engine.contrib.pagination import KeysetPaginator
+from django_mongodb_engine.utils import MaxTimeExceeded
 
 from models import *
 from utils import TestCase, get_collection, skip
@@ -117,6 +126,85 @@ class MapReduceTests(TestCase):
         self.assertEqual(obj, MapReduceModelWithCustomPrimaryKey(pk='bar',
                                                                  data='yo?'))
 
+    def test_iter_group(self):
+        for n, m in [(1, 2), (1, 3), (2, 4)]:
+            MapReduceModel.objects.create(n=n, m=m)
+
+        results = MapReduceModel.objects.iter_group('n', {'$sum': '$m'})
+        self.assertEqual(sorted((result.key, result.value)
+                                for result in results), [(1, 5), (2, 4)])
+        results = MapReduceModel.objects.filter(m__gt=2).iter_group(
+            'n', {'total': {'$sum': '$m'}, 'count': {'$sum': 1}})
+        self.assertEqual(sorted((result.key, result.value)
+                                for result in results),
+                         [(1, {'total': 3, 'count': 1}),
+                          (2, {'total': 4, 'count': 1})])
+
+        self.assertRaises(ValueError,
+                          MapReduceModel.objects.iter_group, 'n', {})
+
+    def test_incremental_map_reduce(self):
+        mapfunc = """ function() { emit(this.n, this.m) } """
+        reducefunc = """
+            function(key, values) {
+                var res = 0
+                values.forEach(function(x) { res += x })
+                return res
+            }
+        """
+        output = get_collection('m/r-incremental')
+        jobs = get_collection(MapReduceJob.collection_name)
+        self.addCleanup(output.drop)
+        self.addCleanup(jobs.drop)
+
+        def results():
+            return dict((doc['_id'], doc['value']) for doc in output.find())
+
+        for n, m in [(1, 2), (1, 3), (2, 4)]:
+            obj = MapReduceModel.objects.create(n=n, m=m)
+        job = MapReduceModel.objects.incremental_map_reduce(
+            'sum', mapfunc, reducefunc, out='m/r-incremental')
+        self.assertEqual(results(), {1: 5, 2: 4})
+        self.assertEqual(job.state['runs'], 1)
+        self.assertEqual(job.state['watermark'], ObjectId(obj.pk))
+        self.assertEqual(job.state['pending'], None)
+
+        # Only new documents are processed.
+        MapReduceModel.objects.create(n=2, m=1)
+        obj = MapReduceModel.objects.create(n=3, m=7)
+        self.assertEqual(job.run(), 2)
+        self.assertEqual(results(), {1: 5, 2: 5, 3: 7})
+        self.assertEqual(job.run(), 0)
+        self.assertEqual(job.state['runs'], 2)
+
+        # A run that crashed before the Map/Reduce is repeated...
+        obj = MapReduceModel.objects.create(n=3, m=1)
+        pending = {'watermark': ObjectId(obj.pk), 'run': 'crashed'}
+        jobs.update({'_id': 'sum'}, {'$set': {'pending': pending}})
+        self.assertEqual(job.state['pending'], ObjectId(obj.pk))
+        self.assertEqual(job.run(), 1)
+        self.assertEqual(results(), {1: 5, 2: 5, 3: 8})
+
+        # ...but not if it crashed after writing its results.
+        obj = MapReduceModel.objects.create(n=1, m=1)
+        pending = {'watermark': ObjectId(obj.pk), 'run': 'crashed-later'}
+        jobs.update({'_id': 'sum'}, {'$set': {'pending': pending}})
+        job._map_reduce(job._get_query(), job.state['watermark'], pending)
+        self.assertEqual(job.run(), 0)
+        self.assertEqual(results(), {1: 6, 2: 5, 3: 8})
+        self.assertEqual(job.state['runs'], 4)
+        self.assertEqual(job.state['pending'], None)
+
+        # Only documents matching the queryset are processed.
+        MapReduceModel.objects.create(n=2, m=10)
+        MapReduceModel.objects.create(n=4, m=10)
+        MapReduceModel.objects.filter(n__gt=2).incremental_map_reduce(
+            'sum', mapfunc, reducefunc, out='m/r-incremental')
+        self.assertEqual(results(), {1: 6, 2: 5, 3: 8, 4: 10})
+
+        job.reset()
+        self.assertEqual(job.state['watermark'], None)
+
 
 class RawQueryTests(TestCase):
 
@@ -154,6 +242,88 @@ class RawQueryTests(TestCase):
                          [1, 1, 1, 1, 4, 5, 6, 7, 8, 9])
 
 
+class FindAndModifyTests(TestCase):
+
+    def setUp(self):
+        for i in xrange(3):
+            MapReduceModel.objects.create(n=i, m=0)
+
+    def tearDown(self):
+        MapReduceModel.objects.all().delete()
+
+    def test_find_and_modify(self):
+        queryset = MapReduceModel.objects.filter(m=0)
+        obj = queryset.find_and_modify(m=F('m') + 1, sort='-n', new=True)
+        self.assertEqual((obj.n, obj.m), (2, 1))
+        self.assertEqual(obj, MapReduceModel.objects.get(n=2))
+        obj.save()
+
+        obj = queryset.order_by('n').find_and_modify(m=5)
+        self.assertEqual((obj.n, obj.m), (0, 0))
+        self.assertEqual(MapReduceModel.objects.get(n=0).m, 5)
+
+        obj = queryset.find_and_modify({'$inc': {'n': 10}}, new=True)
+        self.assertEqual((obj.n, obj.m), (11, 0))
+
+        obj = MapReduceModel.objects.filter(n=11).find_and_modify(remove=True)
+        self.assertEqual(obj.n, 11)
+        self.assertEqual(MapReduceModel.objects.count(), 2)
+
+        self.assertEqual(queryset.find_and_modify(m=1), None)
+        obj = MapReduceModel.objects.filter(n=42).find_and_modify(
+            m=1, upsert=True, new=True)
+        self.assertEqual((obj.n, obj.m), (42, 1))
+
+    def test_get_or_create(self):
+        obj, created = MapReduceModel.objects.get_or_create(
+            n=1, defaults={'m': 5})
+        self.assertFalse(created)
+        self.assertEqual((obj.n, obj.m), (1, 0))
+        obj, created = MapReduceModel.objects.get_or_create(
+            n=7, defaults={'m': 5})
+        self.assertTrue(created)
+        self.assertEqual(MapReduceModel.objects.get(n=7), obj)
+        self.assertEqual(obj.m, 5)
+
+    def test_get_or_create_empty_lookup(self):
+        # Lookups that can't match anything create the object, too.
+        obj, created = MapReduceModel.objects.get_or_create(
+            pk__in=[], defaults={'n': 8, 'm': 5})
+        self.assertTrue(created)
+        self.assertEqual(MapReduceModel.objects.get(pk=obj.pk), obj)
+        self.assertEqual((obj.n, obj.m), (8, 5))
+        obj, created = MapReduceModel.objects.none().get_or_create(
+            n=8, defaults={'m': 5})
+        self.assertTrue(created)
+        self.assertEqual(MapReduceModel.objects.get(pk=obj.pk), obj)
+        obj, created = MapReduceModel.objects.none().update_or_create(
+            n=8, defaults={'m': 6})
+        self.assertTrue(created)
+        self.assertEqual((obj.n, obj.m), (8, 6))
+        self.assertEqual(MapReduceModel.objects.filter(n=8).count(), 3)
+
+    def test_update_or_create(self):
+        obj, created = MapReduceModel.objects.update_or_create(
+            n=1, defaults={'m': 5})
+        self.assertFalse(created)
+        self.assertEqual(MapReduceModel.objects.get(n=1).m, 5)
+        obj, created = MapReduceModel.objects.filter(m=3).update_or_create(
+            n=1, defaults={'m': 3})
+        self.assertTrue(created)
+        self.assertEqual((obj.n, obj.m), (1, 3))
+        self.assertEqual(MapReduceModel.objects.filter(n=1).count(), 2)
+
+    def test_upsert_unique_violation(self):
+        UniqueModel.objects.create(name='a', code='x')
+        # The new object's code violates another unique index.
+        self.assertRaises(IntegrityError, UniqueModel.objects.get_or_create,
+                          name='b', defaults={'code': 'x'})
+        self.assertEqual(UniqueModel.objects.count(), 1)
+        obj, created = UniqueModel.objects.get_or_create(
+            name='a', defaults={'code': 'x'})
+        self.assertFalse(created)
+
+
 # TODO: Line breaks.
 class FullTextTest(TestCase):
 
@@ -248,3 +418,357 @@ class DistinctTests(TestCase):
                          [2, 4, 6, 8, 10, 12, 14, 16, 18])
 
         self.assertEqual(MapReduceModel.objects.filter(n=6).distinct('m'), [12])
+
+    def test_iter_distinct(self):
+        for i in xrange(10):
+            for j in xrange(i):
+                MapReduceModel.objects.create(n=i, m=i * 2)
+
+        self.assertEqual(sorted(MapReduceModel.objects.iter_distinct('m')),
+                         [2, 4, 6, 8, 10, 12, 14, 16, 18])
+        self.assertEqual(
+            list(MapReduceModel.objects.filter(n=6).iter_distinct('m')), [12])
+        self.assertEqual(
+            list(MapReduceModel.objects.none().iter_distinct('m')), [])
+
+        # Embedded fields aren't unwound, documents lacking them are
+        # left out, and lists are unwound into their items.
+        ProjectionModel.objects.create(author=Author(name='a'),
+                                       tags=['x', 'y'])
+        ProjectionModel.objects.create(author=Author(name='b'), tags=['y'])
+        ProjectionModel.objects.create(tags=[])
+        self.assertEqual(
+            sorted(ProjectionModel.objects.iter_distinct('author.name')),
+            sorted(ProjectionModel.objects.distinct('author.name')))
+        self.assertEqual(
+            sorted(ProjectionModel.objects.iter_distinct('tags')),
+            ['x', 'y'])
+
+
+class AggregatePipelineTests(TestCase):
+
+    def setUp(self):
+        for category, n in [('a', 1), ('a', 2), ('b', 3), ('c', 4)]:
+            PipelineModel.objects.create(category=category, n=n)
+
+    def test_aggregate_pipeline(self):
+        results = PipelineModel.objects.filter(n__gt=1).aggregate_pipeline(
+            {'$group': {'_id': '$category', 'total': {'$sum': '$n'}}},
+            {'$sort': {'_id': 1}}, allow_disk_use=True)
+        self.assertEqual(list(results), [{'_id': 'a', 'total': 2},
+                                         {'_id': 'b', 'total': 3},
+                                         {'_id': 'c', 'total': 4}])
+
+    def test_ordering_and_slicing(self):
+        results = PipelineModel.objects.order_by('-n')[1:3] \
+            .aggregate_pipeline({'$project': {'_id': 0, 'n': 1}})
+        self.assertEqual(list(results), [{'n': 3}, {'n': 2}])
+        self.assertEqual(
+            list(PipelineModel.objects.none().aggregate_pipeline()), [])
+
+    def test_field_names(self):
+        obj = PipelineModel.objects.get(n=3)
+        results = PipelineModel.objects.aggregate_pipeline(
+            {'$match': {'category': 'b'}},
+            {'$project': {'pk': 1, 'category': 1, 'double': {
+                '$multiply': ['$n', 2]}}})
+        self.assertEqual(list(results), [{'_id': ObjectId(obj.pk),
+                                          'cat': 'b', 'double': 6}])
+
+    def test_out(self):
+        self.assertEqual(
+            PipelineModel.objects.filter(category='a').aggregate_pipeline(
+                {'$project': {'n': 1}}, {'$out': 'pipeline_out'}),
+            None)
+        collection = get_collection('pipeline_out')
+        try:
+            self.assertEqual(sorted(doc['n'] for doc in collection.find()),
+                             [1, 2])
+        finally:
+            collection.drop()
+
+    def test_out_empty(self):
+        # Empty querysets still replace the output collection.
+        collection = get_collection('pipeline_out')
+        collection.insert({'n': 42})
+        try:
+            for queryset in [PipelineModel.objects.none(),
+                             PipelineModel.objects.filter(n__in=[]),
+                             PipelineModel.objects.all()[2:2]]:
+                self.assertEqual(queryset.aggregate_pipeline(
+                    {'$out': 'pipeline_out'}), None)
+                self.assertEqual(list(collection.find()), [])
+                collection.insert({'n': 42})
+        finally:
+            collection.drop()
+
+
+class KeysetPaginationTests(TestCase):
+
+    def setUp(self):
+        for i in xrange(10):
+            MapReduceModel.objects.create(n=i % 3, m=i)
+
+    def tearDown(self):
+        MapReduceModel.objects.all().delete()
+
+    def test_paginator(self):
+        paginator = KeysetPaginator(MapReduceModel.objects.order_by('-n'), 4)
+        self.assertEqual(paginator.num_pages, 3)
+
+        pages = [paginator.page()]
+        while pages[-1].has_next():
+            pages.append(paginator.page(pages[-1].next_page_number()))
+        self.assertEqual([[(obj.n, obj.m) for obj in page]
+                          for page in pages],
+                         [[(2, 2), (2, 5), (2, 8), (1, 1)],
+                          [(1, 4), (1, 7), (0, 0), (0, 3)],
+                          [(0, 6), (0, 9)]])
+        self.assertEqual([(page.start_index(), page.end_index())
+                          for page in pages], [(1, 4), (5, 8), (9, 10)])
+        self.assertFalse(pages[0].has_previous())
+        self.assertTrue(pages[-1].has_previous())
+
+        previous = paginator.page(pages[-1].previous_page_number())
+        self.assertEqual(list(previous), list(pages[1]))
+        self.assertEqual((previous.start_index(), previous.end_index()),
+                         (5, 8))
+        self.assertTrue(previous.has_next())
+        first = paginator.page(previous.previous_page_number())
+        self.assertEqual(list(first), list(pages[0]))
+        self.assertEqual(first.start_index(), 1)
+        self.assertFalse(first.has_previous())
+
+        self.assertRaises(InvalidPage, paginator.page, 'foo')
+
+    def test_queryset_method(self):
+        page = MapReduceModel.objects.filter(n=1).order_by('m') \
+            .keyset_page(2)
+        self.assertEqual([obj.m for obj in page], [1, 4])
+        page = MapReduceModel.objects.filter(n=1).order_by('m') \
+            .keyset_page(2, page.next_token)
+        self.assertEqual([obj.m for obj in page], [7])
+        self.assertFalse(page.has_next())
+
+
+class QueryOptionsTests(TestCase):
+
+    def setUp(self):
+        for i in xrange(10):
+            MapReduceModel.objects.create(n=i, m=i)
+
+    def tearDown(self):
+        MapReduceModel.objects.all().delete()
+
+    def test_batch_size(self):
+        queryset = MapReduceModel.objects.batch_size(3).order_by('n')
+        self.assertEqual([obj.n for obj in queryset], range(10))
+        self.assertEqual([obj.n for obj in queryset.filter(n__gt=4)],
+                         range(5, 10))
+        self.assertEqual(queryset.filter(n__gt=4).count(), 5)
+
+    def test_no_timeout(self):
+        self.assertEqual(
+            MapReduceModel.objects.no_timeout().filter(n__lt=5).count(), 5)
+
+    def test_max_time(self):
+        slow = MapReduceModel.objects.raw_query(
+            {'$where': 'sleep(100) || true'})
+        self.assertRaises(MaxTimeExceeded, list, slow.max_time(10))
+        self.assertRaises(MaxTimeExceeded, slow.max_time(10).count)
+        self.assertEqual(len(slow.max_time(5000)[:1]), 1)
+        self.assertEqual(len(slow.max_time(10).max_time(None)[:1]), 1)
+
+    def test_read_preference(self):
+
+        def get_read_preference(queryset):
+            collection = _compiler_for_queryset(queryset).get_collection()
+            return collection.read_preference
+
+        queryset = MapReduceModel.objects.read_preference('secondaryPreferred')
+        self.assertEqual(get_read_preference(queryset),
+                         ReadPreference.SECONDARY_PREFERRED)
+        self.assertEqual(get_read_preference(MapReduceModel.objects.all()),
+                         ReadPreference.PRIMARY)
+        # A standalone server serves secondaryPreferred reads.
+        self.assertEqual(queryset.filter(n__lt=5).count(), 5)
+
+        SecondaryReadModel.objects.create(n=1)
+        self.assertEqual(get_read_preference(SecondaryReadModel.objects.all()),
+                         ReadPreference.SECONDARY_PREFERRED)
+        queryset = SecondaryReadModel.objects.read_preference('primary')
+        self.assertEqual(get_read_preference(queryset),
+                         ReadPreference.PRIMARY)
+        self.assertEqual(queryset.get().n, 1)
+        SecondaryReadModel.objects.all().delete()
+
+        self.assertRaises(ValueError, MapReduceModel.objects.read_preference,
+                          'tertiary')
+
+    def test_iterator(self):
+        queryset = MapReduceModel.objects.order_by('n')
+        self.assertEqual([obj.n for obj in queryset.iterator(batch_size=2)],
+                         range(10))
+        # Stopping early closes the cursor.
+        iterator = queryset.iterator(batch_size=2)
+        self.assertEqual(iterator.next().n, 0)
+        iterator.close()
+        self.assertRaises(StopIteration, iterator.next)
+
+
+class WriteConcernTests(TestCase):
+
+    def tearDown(self):
+        WriteConcernModel.objects.all().delete()
+
+    def get_options(self, queryset, operation='update'):
+        return _compiler_for_queryset(queryset).get_write_options(operation)
+
+    def test_write_concern(self):
+        queryset = WriteConcernModel.objects.all()
+        self.assertEqual(self.get_options(queryset)['w'], 0)
+        self.assertEqual(self.get_options(queryset, 'delete')['w'], 0)
+        queryset = queryset.write_concern(w='majority', wtimeout=1000)
+        self.assertEqual(self.get_options(queryset)['w'], 'majority')
+        self.assertEqual(self.get_options(queryset.filter(n=1))['wtimeout'],
+                         1000)
+        with connections['default'].write_concern(w=1):
+            self.assertEqual(
+                self.get_options(WriteConcernModel.objects.all())['w'], 1)
+            self.assertEqual(self.get_options(queryset)['w'], 'majority')
+        self.assertEqual(
+            self.get_options(MapReduceModel.objects.write_concern(j=True)),
+            dict(self.get_options(MapReduceModel.objects.all()), j=True))
+
+    def test_acknowledged_writes(self):
+        obj = WriteConcernModel(n=1)
+        obj.save(write_concern={'w': 1})
+        self.assertEqual(WriteConcernModel.objects.get().n, 1)
+        queryset = WriteConcernModel.objects.write_concern(w=1)
+        self.assertEqual(queryset.update(n=2), 1)
+        queryset.bulk_create([WriteConcernModel(n=3)])
+        self.assertEqual(WriteConcernModel.objects.count(), 2)
+        queryset.filter(n=2).delete()
+        self.assertEqual(WriteConcernModel.objects.get().n, 3)
+
+
+class ProjectionTests(TestCase):
+
+    def setUp(self):
+        ProjectionModel.objects.create(
+            title='title', body='body', tags=['a', 'b', 'c'],
+            author=Author(name='name', email='mail'))
+
+    def tearDown(self):
+        ProjectionModel.objects.all().delete()
+
+    def get_projection(self, queryset):
+        # The projection stage of the query plan holds the projection.
+        # values() querysets aren't MongoDBQuerySets, so wrap the query.
+        queryset = MongoDBQuerySet(queryset.model, queryset.query,
+                                   queryset.db)
+        for stage in queryset.explain().stages:
+            if 'transformBy' in stage:
+                return stage['transformBy']
+        return None
+
+    def test_only_and_defer(self):
+        self.assertEqual(self.get_projection(ProjectionModel.objects.all()),
+                         None)
+        queryset = ProjectionModel.objects.only('title')
+        self.assertEqual(self.get_projection(queryset),
+                         {'_id': 1, 'title': 1})
+        self.assertEqual(queryset.get().title, 'title')
+        self.assertEqual(
+            self.get_projection(ProjectionModel.objects.defer('body', 'tags')),
+            {'_id': 1, 'title': 1, 'author': 1})
+
+    def test_values(self):
+        queryset = ProjectionModel.objects.values('title')
+        self.assertEqual(self.get_projection(queryset),
+                         {'_id': 0, 'title': 1})
+        self.assertEqual(list(queryset), [{'title': 'title'}])
+        self.assertEqual(
+            list(ProjectionModel.objects.values_list('title', flat=True)),
+            ['title'])
+
+    def test_embedded(self):
+        queryset = ProjectionModel.objects.only('title', 'author__email')
+        self.assertEqual(self.get_projection(queryset),
+                         {'_id': 1, 'title': 1, 'author.mail': 1})
+        author = queryset.get().author
+        self.assertEqual((author.name, author.email), ('', 'mail'))
+
+    def test_slice(self):
+        queryset = ProjectionModel.objects.slice('tags', -2)
+        self.assertEqual(self.get_projection(queryset),
+                         {'tags': {'$slice': -2}})
+        self.assertEqual(queryset.get().tags, ['b', 'c'])
+        self.assertEqual(
+            ProjectionModel.objects.slice('tags', [1, 1]).only('tags')
+                .get().tags, ['b'])
+
+
+class ExplainTests(TestCase):
+
+    def setUp(self):
+        for i in xrange(5):
+            MapReduceModel.objects.create(n=i, m=i)
+
+    def tearDown(self):
+        MapReduceModel.objects.all().delete()
+
+    def test_explain(self):
+        plan = MapReduceModel.objects.filter(n__lt=2).explain()
+        self.assertTrue(plan.collection_scan)
+        self.assertFalse(plan.in_memory_sort)
+        self.assertEqual(plan.index, None)
+        self.assertEqual(plan.docs_examined, 5)
+        self.assertEqual(plan.returned, 2)
+
+        plan = MapReduceModel.objects.order_by('-id').explain()
+        self.assertFalse(plan.collection_scan)
+        self.assertFalse(plan.in_memory_sort)
+        self.assertEqual(plan.index, '_id_')
+
+        self.assertTrue(MapReduceModel.objects.order_by('n').explain()
+                        .in_memory_sort)
+
+
+class HintTests(TestCase):
+
+    def setUp(self):
+        for i in xrange(6):
+            IndexedModel.objects.create(a=i % 2, b=i)
+
+    def tearDown(self):
+        IndexedModel.objects.all().delete()
+
+    def test_hint(self):
+        queryset = IndexedModel.objects.filter(a=1, b__gt=1)
+        self.assertEqual(queryset.hint('b_index').explain().index, 'b_index')
+        self.assertEqual(queryset.hint(['a', ('b', -1)]).explain().index,
+                         'a_1_b_-1')
+        self.assertEqual(queryset.hint('a').explain().index, 'a_1')
+
+        hinted = queryset.hint('b_index')
+        self.assertEqual(sorted(obj.b for obj in hinted), [3, 5])
+        self.assertEqual(hinted.filter(b__lt=5).count(), 1)
+        self.assertEqual(sorted(hinted.distinct('b')), [3, 5])
+        self.assertEqual(hinted.hint(None).count(), 2)
+
+    def test_hinted_distinct(self):
+        IndexedModel.objects.create(a=7, b=7, c=1, tags=['x', 'y'])
+        IndexedModel.objects.create(a=7, b=8, c=None, tags=None)
+        IndexedModel.objects.create(a=7, b=9, c=1, tags=[])
+        queryset = IndexedModel.objects.filter(a=7)
+        for key in ['c', 'tags', 'pk']:
+            self.assertEqual(sorted(queryset.hint('a').distinct(key)),
+                             sorted(queryset.distinct(key)))
+        self.assertEqual(sorted(queryset.hint('a').distinct('tags')),
+                         [None, 'x', 'y'])
+
+    def test_undeclared_index(self):
+        self.assertRaises(DatabaseError, IndexedModel.objects.hint, 'b')
+        self.assertRaises(DatabaseError, IndexedModel.objects.hint,
+                          [('a', -1)])
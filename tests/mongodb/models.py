@@ -143,3 +143,17 @@ class CappedCollection3(models.Model):
     class MongoMeta:
         capped = True
         collection_size = 1000
+
+
+class TrackedEmbedded(models.Model):
+    a = models.IntegerField()
+    b = models.IntegerField(null=True)
+
+
+class TrackedModel(models.Model):
+    n = models.IntegerField()
+    tags = ListField()
+    embedded = EmbeddedModelField(TrackedEmbedded, null=True)
+
+    class MongoMeta:
+        track_changes = True
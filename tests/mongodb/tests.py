@@ -6,9 +6,11 @@ from django.contrib.sites.models import Site
 from django.db import connection
 from django.db.utils import DatabaseError, IntegrityError
 from django.db.models import Q
+from bson.objectid import ObjectId
 from gridfs import GridOut
 from pymongo import ASCENDING, DESCENDING, ReadPreference, version_tuple as pymongo_version
 from django_mongodb_engine.base import DatabaseWrapper
+from django_mongodb_engine.utils import QueryPlanError
 from models import *
 
 
@@ -74,6 +76,46 @@ class MongoDBEngineTests(TestCase):
             for call in calls:
                 call()
 
+    def test_collection_cache(self):
+        wrapper = DatabaseWrapper(connection.settings_dict)
+        self.assertIs(wrapper.get_collection('foo'),
+                      wrapper.get_collection('foo'))
+
+        self.assertEqual(wrapper.get_collection('newcoll', existing=True),
+                         None)
+        # Created implicitly by an insert, not through the engine.
+        wrapper.database.newcoll.insert({})
+        self.assertNotEqual(wrapper.get_collection('newcoll', existing=True),
+                            None)
+        wrapper.database.drop_collection('newcoll')
+        # Dropped without the engine, so still known until invalidated.
+        self.assertNotEqual(wrapper.get_collection('newcoll', existing=True),
+                            None)
+        wrapper.invalidate_collection_names()
+        self.assertEqual(wrapper.get_collection('newcoll', existing=True),
+                         None)
+
+    def test_shared_client(self):
+        wrapper1 = DatabaseWrapper(connection.settings_dict)
+        wrapper2 = DatabaseWrapper(connection.settings_dict)
+        self.assertIs(wrapper1.connection, wrapper2.connection)
+        self.assertGreaterEqual(wrapper1.get_pool_stats()['connects'], 2)
+
+        unshared = DatabaseWrapper(dict(connection.settings_dict,
+                                        OPTIONS={'SHARE_CLIENT': False}))
+        self.assertIsNot(unshared.connection, wrapper1.connection)
+        self.assertEqual(unshared.get_pool_stats(), None)
+        unshared.connection.close()
+
+    def test_bulk_create(self):
+        objs = RawModel.objects.bulk_create(
+            [RawModel(raw=i) for i in xrange(10)])
+        self.assertEqual(RawModel.objects.count(), 10)
+        self.assertEqual(len(set(obj.pk for obj in objs)), 10)
+        for obj in objs:
+            self.assertIsInstance(obj.pk, unicode)
+            self.assertEqual(RawModel.objects.get(pk=obj.pk).raw, obj.raw)
+
     def test_tellsiteid(self):
         from django.contrib.sites.models import Site
         site_id = Site.objects.create().id
@@ -262,6 +304,58 @@ class DatabaseOptionTests(TestCase):
         test_setup({ 'insert': {'fsync': True}, 'delete': {'fsync': True}}, save={}, update={'multi': True}, remove={'fsync': True})
 
 
+    def test_unordered_bulk_create(self):
+        posts = [Post(title='a'), Post(title='a'), Post(title='b')]
+        self.assertRaises(IntegrityError, Post.objects.bulk_create, posts)
+        self.assertEqual(Post.objects.count(), 1)
+        Post.objects.all().delete()
+
+        options = {'OPTIONS': {'OPERATIONS': {
+            'bulk_create': {'ordered': False}}}}
+        with self.custom_database_wrapper(options):
+            self.assertRaises(IntegrityError, Post.objects.bulk_create, posts)
+            self.assertEqualLists(
+                Post.objects.order_by('title').values_list('title', flat=True),
+                ['a', 'b'])
+
+    def test_single_object_bulk_create(self):
+        from pymongo.collection import Collection
+        calls = []
+
+        class RecordingCollection(Collection):
+
+            def insert(self, *args, **kwargs):
+                calls.append('insert')
+                return super(RecordingCollection, self).insert(*args,
+                                                               **kwargs)
+
+            def save(self, *args, **kwargs):
+                calls.append('save')
+                return super(RecordingCollection, self).save(*args, **kwargs)
+
+        with self.custom_database_wrapper(
+                {}, collection_class=RecordingCollection):
+            obj, = Post.objects.bulk_create([Post(title='a')])
+            self.assertEqual(calls, ['insert'])
+            Post(title='b').save()
+            self.assertEqual(calls[1], 'save')
+            Post.objects.bulk_create([Post(pk=str(ObjectId()), title='c')])
+            self.assertEqual(calls[2], 'insert')
+        self.assertEqual(Post.objects.get(pk=obj.pk).title, 'a')
+
+    def test_check_query_plans(self):
+        obj = RawModel.objects.create(raw=1)
+        RawModel.objects.create(raw=2)
+        options = {'OPTIONS': {'CHECK_QUERY_PLANS': {'action': 'raise'}}}
+        with self.custom_database_wrapper(options):
+            self.assertRaises(QueryPlanError, list,
+                              RawModel.objects.filter(raw=1))
+            self.assertEqual(RawModel.objects.get(pk=obj.pk), obj)
+
+        options['OPTIONS']['CHECK_QUERY_PLANS']['threshold'] = 3
+        with self.custom_database_wrapper(options):
+            self.assertEqual(len(RawModel.objects.filter(raw=1)), 1)
+
     def test_unique_safe(self):
         Post.objects.create(title='a')
         self.assertRaises(IntegrityError, Post.objects.create, title='a')
@@ -508,3 +602,33 @@ class CappedCollectionTests(TestCase):
         self.assertEqualLists(
             CappedCollection3.objects.reverse().values_list('n', flat=True),
             [3, 2, 1])
+
+
+class ChangeTrackingTests(TestCase):
+
+    def test_save_changes(self):
+        obj = TrackedModel.objects.create(
+            n=1, tags=['a'], embedded=TrackedEmbedded(a=1, b=2))
+        obj = TrackedModel.objects.get(pk=obj.pk)
+        # Concurrent updates of other fields aren't overwritten.
+        get_collection(TrackedModel).update(
+            {'_id': ObjectId(obj.pk)},
+            {'$set': {'n': 2, 'embedded.a': 2}})
+        obj.tags.append('b')
+        obj.embedded.b = 3
+        obj.save()
+        obj = TrackedModel.objects.get(pk=obj.pk)
+        self.assertEqual((obj.n, obj.tags, obj.embedded.a, obj.embedded.b),
+                         (2, ['a', 'b'], 2, 3))
+
+        obj.embedded = None
+        obj.save()
+        self.assertEqual(TrackedModel.objects.get(pk=obj.pk).embedded, None)
+
+    def test_save_deleted(self):
+        obj = TrackedModel.objects.create(n=1, tags=[])
+        obj = TrackedModel.objects.get(pk=obj.pk)
+        TrackedModel.objects.all().delete()
+        obj.n = 2
+        obj.save()
+        self.assertEqual(TrackedModel.objects.get(pk=obj.pk).n, 2)
@@ -49,6 +49,20 @@ class DateModel(models.Model):
     datelist = ListField(models.DateField(), default=_datelist_default)
 
 
+class DatePartsModel(models.Model):
+    datetime = models.DateTimeField(null=True)
+
+    class MongoMeta:
+        date_parts = {'datetime': ['month', 'week_day']}
+
+
+class CaseInsensitiveModel(models.Model):
+    name = models.CharField(max_length=100)
+
+    class MongoMeta:
+        case_insensitive_fields = ['name']
+
+
 class Article(models.Model):
     headline = models.CharField(max_length=50)
     pub_date = models.DateTimeField()
@@ -1,14 +1,24 @@
+from cStringIO import StringIO
 import datetime
 from operator import attrgetter
+import threading
 
+from django.core.management import call_command
 from django.db.models import F, Q
 from django.db.utils import DatabaseError
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.tzinfo import FixedOffset
 # handle pymongo backward compatibility
 try:
     from bson.objectid import ObjectId
 except ImportError:
     from pymongo.objectid import ObjectId
 
+from django_mongodb_engine.query import AddToSet, CurrentDate, MaxUpdate, \
+    MinUpdate, Pop, Pull, Push
+from django_mongodb_engine.utils import LRUCache, backfill_shadow_columns
+
 from models import *
 from utils import *
 
@@ -69,6 +79,55 @@ class BasicQueryTests(TestCase):
         self.assertEqual(
             Person.objects.filter(age__gte=20, surname="duck").count(), 2)
 
+    def test_filter_cache(self):
+        from django_mongodb_engine.compiler import filter_cache
+        Blog.objects.create(title="foo")
+        Blog.objects.create(title="bar")
+        Blog.objects.filter(title__startswith="f").count()
+        hits = filter_cache.hits
+        # Same shape, different values: served from the cache.
+        self.assertEqual(
+            Blog.objects.filter(title__startswith="b").count(), 1)
+        self.assertEqual(
+            Blog.objects.filter(title__startswith="x").count(), 0)
+        self.assertEqual(filter_cache.hits, hits + 2)
+        self.assertEqual(
+            [blog.title for blog in
+             Blog.objects.exclude(title__startswith="f")], ["bar"])
+        self.assertEqual(
+            Blog.objects.filter(title__in=["foo", "bar"])
+                .filter(title__in=["foo"]).count(), 1)
+        # Merging bounds needs the values, so can't be cached.
+        self.assertEqual(
+            Blog.objects.filter(title__gt="a").filter(title__gt="c").count(),
+            1)
+        self.assertEqual(
+            Blog.objects.filter(title__gt="c").filter(title__gt="a").count(),
+            1)
+
+    def test_lru_cache_threads(self):
+        cache = LRUCache(50)
+        errors = []
+
+        def use_cache(offset):
+            try:
+                for i in xrange(2000):
+                    key = (offset + i) % 200
+                    if cache.get(key) is None:
+                        cache.set(key, key)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=use_cache, args=(i * 7,))
+                   for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(len(cache) <= 50)
+        self.assertEqual(cache.hits + cache.misses, 8 * 2000)
+
     def test_isnull(self):
         p1 = Post.objects.create(title='a')
         p2 = Post.objects.create(title='b',
@@ -146,6 +205,117 @@ class BasicQueryTests(TestCase):
         self.assertEqualLists(
             Post.objects.filter(date_published__year=before.year), [entry2])
 
+    def test_date_parts(self):
+        dates = [datetime.date(2015, 3, 1), datetime.date(2015, 3, 2),
+                 datetime.date(2016, 4, 1)]
+        objs = [DateModel.objects.create(date=date) for date in dates]
+        self.assertEqualLists(DateModel.objects.filter(date__month=3),
+                              objs[:2])
+        self.assertEqualLists(DateModel.objects.filter(date__day=1),
+                              [objs[0], objs[2]])
+        # 2015-03-01 was a Sunday.
+        self.assertEqualLists(DateModel.objects.filter(date__week_day=1),
+                              [objs[0]])
+        self.assertEqualLists(
+            DateModel.objects.exclude(date__month=3).filter(date__day=1),
+            [objs[2]])
+
+        DateModel.objects.update(datetime=datetime.datetime(2015, 3, 1, 10))
+        DateModel.objects.filter(pk=objs[0].pk).update(
+            datetime=datetime.datetime(2015, 3, 1, 13, 30))
+        self.assertEqualLists(DateModel.objects.filter(datetime__hour=13),
+                              [objs[0]])
+
+    def test_date_parts_shadow_columns(self):
+        obj = DatePartsModel.objects.create(
+            datetime=datetime.datetime(2015, 3, 1, 13, 30))
+        other = DatePartsModel.objects.create()
+        self.assertEqual(get_collection(DatePartsModel).find_one(
+            {'_id': ObjectId(obj.pk)}, {'_id': 0}),
+            {'datetime': datetime.datetime(2015, 3, 1, 13, 30),
+             'datetime__month': 3, 'datetime__week_day': 1})
+        self.assertEqualLists(
+            DatePartsModel.objects.filter(datetime__month=3), [obj])
+        self.assertEqualLists(
+            DatePartsModel.objects.exclude(datetime__month=3), [other])
+        self.assertEqualLists(
+            DatePartsModel.objects.filter(datetime__week_day=1,
+                                          datetime__hour=13), [obj])
+
+        DatePartsModel.objects.filter(pk=other.pk).update(
+            datetime=datetime.datetime(2015, 4, 2))
+        self.assertEqualLists(
+            DatePartsModel.objects.filter(datetime__month=4), [other])
+        self.assertEqualLists(
+            DatePartsModel.objects.filter(datetime__week_day=5), [other])
+
+    def test_date_parts_time_zones(self):
+        with override_settings(USE_TZ=True, TIME_ZONE='UTC'):
+            obj = DatePartsModel.objects.create(datetime=datetime.datetime(
+                2015, 3, 31, 23, 30, tzinfo=timezone.utc))
+            self.assertEqualLists(
+                DatePartsModel.objects.filter(datetime__month=3), [obj])
+            # The shadow columns hold the parts in the default time zone,
+            # other time zones fall back to $expr queries.
+            with timezone.override(FixedOffset(60)):
+                self.assertEqualLists(
+                    DatePartsModel.objects.filter(datetime__month=3), [])
+                self.assertEqualLists(
+                    DatePartsModel.objects.filter(datetime__month=4), [obj])
+            self.assertEqualLists(
+                DatePartsModel.objects.filter(datetime__month=4), [])
+
+    def test_case_insensitive_fields(self):
+        objs = [CaseInsensitiveModel.objects.create(name=name)
+                for name in ('Alice', 'ALICE', 'Bob', 'al*')]
+        self.assertEqual(get_collection(CaseInsensitiveModel).find_one(
+            {'_id': ObjectId(objs[0].pk)}, {'_id': 0}),
+            {'name': 'Alice', 'name__lower': 'alice'})
+        self.assertEqualLists(
+            CaseInsensitiveModel.objects.filter(name__iexact='aLiCe'),
+            objs[:2])
+        self.assertEqualLists(
+            CaseInsensitiveModel.objects.filter(name__istartswith='AL'),
+            [objs[0], objs[1], objs[3]])
+        self.assertEqualLists(
+            CaseInsensitiveModel.objects.filter(name__istartswith='AL*'),
+            [objs[3]])
+        self.assertEqualLists(
+            CaseInsensitiveModel.objects.filter(name__icontains='O'),
+            [objs[2]])
+        self.assertEqualLists(
+            CaseInsensitiveModel.objects.exclude(name__iexact='alice'),
+            objs[2:])
+        self.assertEqualLists(
+            CaseInsensitiveModel.objects.filter(name__exact='Alice'),
+            [objs[0]])
+
+        CaseInsensitiveModel.objects.filter(pk=objs[2].pk).update(
+            name='ALFRED')
+        self.assertEqualLists(
+            CaseInsensitiveModel.objects.filter(name__iexact='alfred'),
+            [objs[2]])
+
+    def test_backfill_shadow_columns(self):
+        # Documents saved before the option was added.
+        collection = get_collection(CaseInsensitiveModel)
+        collection.insert([{'name': 'Alice'}, {'name': 'Bob'}])
+        self.assertEqual(
+            CaseInsensitiveModel.objects.filter(name__iexact='alice').count(),
+            0)
+
+        stdout = StringIO()
+        call_command('backfillshadowcolumns', 'query', stdout=stdout)
+        self.assertIn("Backfilled 2 documents of query.CaseInsensitiveModel",
+                      stdout.getvalue())
+        self.assertEqual(
+            [obj.name for obj in
+             CaseInsensitiveModel.objects.filter(name__iexact='alice')],
+            ['Alice'])
+        self.assertEqual(
+            backfill_shadow_columns(collection,
+                                    CaseInsensitiveModel._meta), 0)
+
     def test_simple_foreign_keys(self):
         blog1 = Blog.objects.create(title="Blog")
         entry1 = Post.objects.create(title="entry 1", blog=blog1)
@@ -233,8 +403,8 @@ class BasicQueryTests(TestCase):
         self.assertEqual(
             Post.objects.filter(title__startswith='T', title__contains=' ')
                         .filter(content__startswith='C')
-                        .get(~Q(content__contains='Y',
-                                content__icontains='B')),
+                        .filter(~Q(content__contains='Y'))
+                        .get(~Q(content__icontains='B')),
             Post.objects.all()[0])
 
         self.assertEqualLists(
@@ -330,6 +500,67 @@ class BasicQueryTests(TestCase):
                                   Q(title='1')).order_by('id'),
             [obj1, obj2, obj4])
 
+    def test_complex_or_queries(self):
+        for i in range(6):
+            IntegerModel.objects.create(integer=i)
+
+        def integers(queryset):
+            return sorted(obj.integer for obj in queryset)
+
+        # Multiple ORs.
+        self.assertEqual(
+            integers(IntegerModel.objects.filter(Q(integer=1) |
+                                                 Q(integer=2) |
+                                                 Q(integer__in=[4, 5]))),
+            [1, 2, 4, 5])
+        self.assertEqual(
+            integers(IntegerModel.objects
+                        .filter(Q(integer__lt=2) | Q(integer__gt=3))
+                        .filter(Q(integer=1) | Q(integer=4))),
+            [1, 4])
+
+        # Nested ORs.
+        self.assertEqual(
+            integers(IntegerModel.objects.filter(
+                Q(integer=0) | (Q(integer__gt=2) &
+                                (Q(integer=3) | Q(integer=5))))),
+            [0, 3, 5])
+
+        # An OR with a branch matching everything matches everything.
+        self.assertEqual(
+            integers(IntegerModel.objects.filter(Q(integer=1) | Q())),
+            range(6))
+
+        # Negated ORs and ANDs.
+        self.assertEqual(
+            integers(IntegerModel.objects.exclude(Q(integer=1) |
+                                                  Q(integer__gt=3))),
+            [0, 2, 3])
+        self.assertEqual(
+            integers(IntegerModel.objects.exclude(integer__gt=1,
+                                                  integer__lt=4)),
+            [0, 1, 4, 5])
+        self.assertEqual(
+            integers(IntegerModel.objects.filter(
+                ~(Q(integer__lt=2) | (Q(integer__gt=2) & ~Q(integer=4))))),
+            [2, 4])
+        self.assertEqual(
+            integers(IntegerModel.objects.exclude(integer__range=(1, 4))),
+            [0, 5])
+
+        # Range bounds.
+        self.assertEqual(
+            integers(IntegerModel.objects.filter(integer__gte=1)
+                                         .filter(integer__gt=3)
+                                         .filter(integer__lte=4)),
+            [4])
+
+        query = IntegerModel.objects.filter(
+            Q(integer=1) | Q(integer=2)).query
+        self.assertEqual(query.get_compiler('default').build_query()
+                              .mongo_query,
+                         {'integer': {'$in': [1, 2]}})
+
     def test_can_save_empty_model(self):
         obj = Empty.objects.create()
         self.assertNotEqual(obj.id, None)
@@ -415,6 +646,80 @@ class UpdateTests(TestCase):
         self.assertRaises(AssertionError, Person.objects.update,
                           age=F('name') + 1)
 
+    def test_update_with_operators(self):
+        john = Person.objects.create(name='john', surname='nhoj', age=42)
+        andy = Person.objects.create(name='andy', surname='ydna', age=-5)
+        Person.objects.update(age=F('age') * 2)
+        self.assertEqual(Person.objects.get(pk=john.pk).age, 84)
+        self.assertEqual(Person.objects.get(pk=andy.pk).age, -10)
+        Person.objects.update(age=MaxUpdate(0))
+        self.assertEqual(Person.objects.get(pk=john.pk).age, 84)
+        self.assertEqual(Person.objects.get(pk=andy.pk).age, 0)
+        Person.objects.update(age=MinUpdate(50))
+        self.assertEqual(Person.objects.get(pk=john.pk).age, 50)
+
+        obj = DateModel.objects.create()
+        DateModel.objects.filter(pk=obj.pk).update(datetime=CurrentDate())
+        self.assertNotEqual(DateModel.objects.get(pk=obj.pk).datetime,
+                            obj.datetime)
+
+    def test_update_array(self):
+        day = datetime.date(2013, 1, 1)
+        days = [day + datetime.timedelta(days=i) for i in range(5)]
+        obj = DateModel.objects.create(datelist=days[:1])
+        queryset = DateModel.objects.filter(pk=obj.pk)
+
+        def datelist():
+            return DateModel.objects.get(pk=obj.pk).datelist
+
+        queryset.update(datelist=Push(days[1]))
+        self.assertEqual(datelist(), days[:2])
+        queryset.update(datelist=Push(each=days[2:], slice=-3))
+        self.assertEqual(datelist(), days[2:])
+        queryset.update(datelist=AddToSet(days[2], days[0]))
+        self.assertEqual(datelist(), days[2:] + days[:1])
+        queryset.update(datelist=Pull(days[3], days[4]))
+        self.assertEqual(datelist(), [days[2], days[0]])
+        queryset.update(datelist=Pop())
+        self.assertEqual(datelist(), [days[2]])
+        queryset.update(datelist=Pull(days[2]))
+        self.assertEqual(datelist(), [])
+
+        self.assertRaises(DatabaseError, Person.objects.update,
+                          age=Push(1))
+
+
+class FilterWithFTests(TestCase):
+
+    def setUp(self):
+        for age, another_age in [(1, 2), (2, 2), (3, 2)]:
+            Person.objects.create(name=str(age), surname='', age=age,
+                                  another_age=another_age)
+
+    def ages(self, queryset):
+        return sorted(person.age for person in queryset)
+
+    def test_compare_fields(self):
+        self.assertEqual(
+            self.ages(Person.objects.filter(age__gt=F('another_age'))), [3])
+        self.assertEqual(
+            self.ages(Person.objects.filter(age=F('another_age'))), [2])
+        self.assertEqual(
+            self.ages(Person.objects.exclude(age=F('another_age'))), [1, 3])
+        self.assertEqual(
+            self.ages(Person.objects.filter(age__lte=F('another_age') - 1)),
+            [1])
+        self.assertEqual(
+            self.ages(Person.objects.filter(age__gte=F('another_age'),
+                                            age__lt=F('another_age') * 2)),
+            [2, 3])
+        self.assertEqual(
+            self.ages(Person.objects.filter(Q(age__lt=F('another_age')) |
+                                            Q(age=3))),
+            [1, 3])
+        self.assertRaises(DatabaseError, list,
+                          Person.objects.filter(age__in=F('another_age')))
+
 
 class OrderingTests(TestCase):
 